@@ -0,0 +1,78 @@
+import os
+import re
+import uuid
+import hashlib
+from typing import *
+
+from PIL import Image
+
+# NOTE: content-addressed store shared by the API and the workers, blobs are
+# named after the sha256 of their content
+BLOB_STORE_DIR = os.getenv('BLOB_STORE_DIR', 'server/blobs')
+
+BLOB_ID_REGEX = re.compile(r'^[0-9a-f]{64}$')
+
+
+def is_blob_id(blob_id: str) -> bool:
+    return blob_id is not None and BLOB_ID_REGEX.match(blob_id) is not None
+
+
+def get_blob_path(blob_id: str) -> str:
+    if not is_blob_id(blob_id):
+        raise ValueError(f"INVALID BLOB ID {blob_id}")
+
+    return os.path.join(BLOB_STORE_DIR, blob_id[:2], blob_id)
+
+
+def save_blob_from_stream(
+    stream,
+    chunk_size: int = 64 * 1024,
+) -> str:
+    """
+    Streams `stream` to the store while hashing it, so the upload is never
+    held in memory. Returns the id of the blob.
+    """
+    os.makedirs(BLOB_STORE_DIR, exist_ok=True)
+    tmp_path = os.path.join(BLOB_STORE_DIR, f".{uuid.uuid4().hex}.tmp")
+
+    sha256 = hashlib.sha256()
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                f.write(chunk)
+
+        blob_id = sha256.hexdigest()
+        blob_path = get_blob_path(blob_id)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(tmp_path, blob_path)
+
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return blob_id
+
+
+def save_blob(data: bytes) -> str:
+    blob_id = hashlib.sha256(data).hexdigest()
+    blob_path = get_blob_path(blob_id)
+
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        tmp_path = f"{blob_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, blob_path)
+
+    return blob_id
+
+
+def load_img(blob_id: str):
+    img = Image.open(get_blob_path(blob_id))
+    img.load()
+
+    return img
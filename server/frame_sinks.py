@@ -0,0 +1,142 @@
+import os
+import queue
+import threading
+from io import BytesIO
+from typing import *
+
+PREVIEW_FREQ = int(os.getenv('PREVIEW_FREQ', '5'))
+PREVIEW_SIZE = int(os.getenv('PREVIEW_SIZE', '256'))
+PREVIEW_TTL = 5000
+
+
+def get_preview_key(job_id: str) -> str:
+    return f"preview:{job_id}"
+
+
+class FrameSink:
+    """
+    Receives the frames of a generation as soon as they are produced.
+    """
+    def add_frame(self, img):
+        raise NotImplementedError
+
+    def close(self, ):
+        pass
+
+
+class PreviewFrameSink(FrameSink):
+    """
+    Publishes a downscaled JPEG of every `preview_freq`-th frame as
+    `{out_dir}/preview.jpg` and, when a Redis connection is given, under the
+    preview key of the job so the API can serve it while the job runs.
+    """
+    def __init__(
+        self,
+        out_dir: str,
+        conn=None,
+        job_id: str = None,
+        preview_freq: int = PREVIEW_FREQ,
+        preview_size: int = PREVIEW_SIZE,
+        jpeg_quality: int = 80,
+    ):
+        self.out_dir = out_dir
+        self.conn = conn
+        self.job_id = job_id
+        self.preview_freq = preview_freq
+        self.preview_size = preview_size
+        self.jpeg_quality = jpeg_quality
+
+        self.num_frames = 0
+        self.preview_url = ''
+
+    def add_frame(self, img):
+        self.num_frames += 1
+        if (self.num_frames - 1) % self.preview_freq != 0:
+            return
+
+        preview_img = img.convert('RGB')
+        preview_img.thumbnail((self.preview_size, self.preview_size))
+
+        buffer = BytesIO()
+        preview_img.save(buffer, format='JPEG', quality=self.jpeg_quality)
+        preview_bytes = buffer.getvalue()
+
+        preview_path = f"{self.out_dir}/preview.jpg"
+        with open(f"{preview_path}.tmp", 'wb') as f:
+            f.write(preview_bytes)
+        os.replace(f"{preview_path}.tmp", preview_path)
+
+        if self.conn is not None and self.job_id is not None:
+            self.conn.set(
+                get_preview_key(self.job_id),
+                preview_bytes,
+                ex=PREVIEW_TTL,
+            )
+
+        # NOTE: the frame number busts the browser cache
+        preview_url = '/'.join(preview_path.split('/')[1:])
+        self.preview_url = f"{preview_url}?frame={self.num_frames}"
+
+
+class VideoFrameSink(FrameSink):
+    """
+    Encodes frames into a video on a background thread while the
+    optimization keeps running. Frames go through a bounded queue, so a slow
+    encoder applies backpressure instead of piling frames up in memory.
+    """
+    def __init__(
+        self,
+        out_video_path: str,
+        fps: int = 5,
+        max_queue_size: int = 32,
+    ):
+        self.out_video_path = out_video_path
+        self.fps = fps
+
+        self.frame_queue = queue.Queue(maxsize=max_queue_size)
+        self.num_frames = 0
+        self.error = None
+
+        self.thread = threading.Thread(target=self.encode, daemon=True)
+        self.thread.start()
+
+    def encode(self, ):
+        # NOTE: imported here so that the API process never loads imageio
+        import imageio
+        import numpy as np
+
+        writer = None
+        try:
+            while True:
+                img = self.frame_queue.get()
+                if img is None:
+                    break
+
+                if writer is None:
+                    writer = imageio.get_writer(
+                        self.out_video_path,
+                        fps=self.fps,
+                    )
+                writer.append_data(np.array(img, dtype=np.uint8))
+
+        except Exception as e:
+            self.error = e
+            # NOTE: keeps draining so that `add_frame` never blocks forever
+            while self.frame_queue.get() is not None:
+                pass
+
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def add_frame(self, img):
+        self.num_frames += 1
+        self.frame_queue.put(img)
+
+    def close(self, ):
+        if self.thread.is_alive():
+            self.frame_queue.put(None)
+            self.thread.join()
+
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,63 @@
+from typing import *
+
+# NOTE: written by the API, read by the workers between optimization steps
+CONTROL_TTL = 5000
+
+STOP = 'stop'
+CANCEL = 'cancel'
+
+
+def get_control_key(job_id: str) -> str:
+    return f"job-control:{job_id}"
+
+
+def set_control(
+    conn,
+    job_id: str,
+    control: str,
+):
+    if control not in (STOP, CANCEL):
+        raise ValueError(f"CONTROL {control} NOT RECOGNIZED")
+
+    conn.set(get_control_key(job_id), control, ex=CONTROL_TTL)
+
+
+def get_control(
+    conn,
+    job_id: str,
+) -> Optional[str]:
+    control = conn.get(get_control_key(job_id))
+    if control is None:
+        return None
+
+    return control.decode('utf-8')
+
+
+def clear_control(
+    conn,
+    job_id: str,
+):
+    conn.delete(get_control_key(job_id))
+
+
+class JobControl:
+    """
+    Session callback checking the control flag of a job after every step.
+    Stop ends the session keeping the frames produced so far, cancel ends it
+    and drops them.
+    """
+    def __init__(
+        self,
+        conn,
+        job_id: str,
+    ):
+        self.conn = conn
+        self.job_id = job_id
+
+    def __call__(self, session):
+        control = get_control(self.conn, self.job_id)
+
+        if control == STOP:
+            session.stopped = True
+        elif control == CANCEL:
+            session.cancelled = True
@@ -0,0 +1,172 @@
+import os
+import uuid
+from typing import *
+
+import numpy as np
+import torch
+
+from models.checkpoints import save_state_dict_file
+
+# NOTE: final latents of finished jobs indexed by the CLIP embedding of their
+# prompt. The latents are files shared by the workers through the
+# filesystem, the prompt embeddings a Redis hash per store directory, so a
+# lookup only reads the latents of the entry it picks
+LATENT_STORE_DIR = os.getenv('LATENT_STORE_DIR', 'server/latents')
+LATENT_STORE_MAX_ENTRIES = int(os.getenv('LATENT_STORE_MAX_ENTRIES', '1000'))
+
+# NOTE: cosine similarity between prompt embeddings above which the stored
+# latents are a better start than noise
+WARM_START_MIN_SIMILARITY = float(
+    os.getenv('WARM_START_MIN_SIMILARITY', '0.85'))
+# NOTE: fraction of the fresh initialization blended into the stored latents
+WARM_START_NOISE_FRAC = float(os.getenv('WARM_START_NOISE_FRAC', '0.1'))
+
+
+class LatentStoreBackend:
+    """
+    Redis connection holding the prompt embedding index. Without one the
+    store is disabled.
+    """
+    def __init__(self, ):
+        self.redis_conn = None
+
+
+latent_store_backend = LatentStoreBackend()
+
+
+def set_latent_store_backend(redis_conn=None, ):
+    latent_store_backend.redis_conn = redis_conn
+
+
+def get_shape_str(latent_shape: Tuple[int, ...], ) -> str:
+    return 'x'.join([str(dim) for dim in latent_shape])
+
+
+def get_store_dir(
+    model_name: str,
+    latent_shape: Tuple[int, ...],
+) -> str:
+    return os.path.join(
+        LATENT_STORE_DIR,
+        model_name,
+        get_shape_str(latent_shape),
+    )
+
+
+def get_index_key(
+    model_name: str,
+    latent_shape: Tuple[int, ...],
+) -> str:
+    return f"latent-index:{model_name}:{get_shape_str(latent_shape)}"
+
+
+def get_entry_path(
+    store_dir: str,
+    entry_id: str,
+) -> str:
+    return os.path.join(store_dir, f"{entry_id}.pt")
+
+
+def prune_store(
+    store_dir: str,
+    index_key: str,
+):
+    entry_path_list = [
+        os.path.join(store_dir, filename)
+        for filename in os.listdir(store_dir) if filename.endswith('.pt')
+    ]
+    if len(entry_path_list) <= LATENT_STORE_MAX_ENTRIES:
+        return
+
+    entry_path_list.sort(key=os.path.getmtime)
+    for entry_path in entry_path_list[:-LATENT_STORE_MAX_ENTRIES]:
+        entry_id = os.path.splitext(os.path.basename(entry_path))[0]
+        latent_store_backend.redis_conn.hdel(index_key, entry_id)
+        if os.path.exists(entry_path):
+            os.remove(entry_path)
+
+
+def save_latents(
+    model_name: str,
+    text_logits: torch.Tensor,
+    latents: torch.Tensor,
+):
+    if latent_store_backend.redis_conn is None:
+        return
+
+    latent_shape = tuple(latents.shape)
+    store_dir = get_store_dir(model_name, latent_shape)
+    index_key = get_index_key(model_name, latent_shape)
+    os.makedirs(store_dir, exist_ok=True)
+
+    entry_id = uuid.uuid4().hex
+    save_state_dict_file(
+        {'latents': latents.detach().cpu()},
+        get_entry_path(store_dir, entry_id),
+    )
+
+    text_logits = torch.nn.functional.normalize(
+        text_logits.detach().float().reshape(-1),
+        dim=0,
+    )
+    # NOTE: indexed once the latents are written, so a lookup never picks an
+    # entry without them
+    latent_store_backend.redis_conn.hset(
+        index_key,
+        entry_id,
+        text_logits.cpu().numpy().astype(np.float32).tobytes(),
+    )
+
+    prune_store(store_dir, index_key)
+
+
+def find_latents(
+    model_name: str,
+    latent_shape: Tuple[int, ...],
+    text_logits: torch.Tensor,
+    min_similarity: float = WARM_START_MIN_SIMILARITY,
+) -> Optional[torch.Tensor]:
+    """
+    Returns the stored latents of shape `latent_shape` whose prompt embedding
+    is the closest to `text_logits`, or None if none is at least
+    `min_similarity` close.
+    """
+    if latent_store_backend.redis_conn is None:
+        return None
+
+    index_key = get_index_key(model_name, latent_shape)
+    index = latent_store_backend.redis_conn.hgetall(index_key)
+    if len(index) == 0:
+        return None
+
+    entry_id_list = [entry_id.decode('utf-8') for entry_id in index]
+    stored_text_logits = torch.from_numpy(
+        np.stack([
+            np.frombuffer(text_logits_bytes, dtype=np.float32)
+            for text_logits_bytes in index.values()
+        ]))
+    text_logits = torch.nn.functional.normalize(
+        text_logits.detach().float().reshape(-1).cpu(),
+        dim=0,
+    )
+    similarity = stored_text_logits @ text_logits
+
+    best_similarity, best_idx = similarity.max(0)
+    if best_similarity.item() < min_similarity:
+        return None
+
+    entry_id = entry_id_list[best_idx.item()]
+    entry_path = get_entry_path(
+        get_store_dir(model_name, latent_shape),
+        entry_id,
+    )
+
+    print(f"Warm starting from a prompt {best_similarity.item():.2f} similar")
+    try:
+        entry = torch.load(entry_path, map_location="cpu")
+    except (OSError, RuntimeError, EOFError):
+        # NOTE: pruned by another worker in the meantime
+        latent_store_backend.redis_conn.hdel(index_key, entry_id)
+        return None
+
+    return entry['latents']
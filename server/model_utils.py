@@ -0,0 +1,126 @@
+import os
+from typing import *
+
+MODEL_LIST = ['aphantasia', 'stylegan', 'taming']
+
+# NOTE: CLIP model every generator computes its loss with
+CLIP_MODEL_NAME = 'ViT-B/32'
+
+# NOTE: resolution StyleGAN computes the CLIP loss at. 1024, the default,
+# runs the full synthesis, lower values opt in to the faster partial synthesis
+# with a fitted to-RGB layer, which changes the outputs
+STYLEGAN_LOSS_RESOLUTION = int(os.getenv('STYLEGAN_LOSS_RESOLUTION', '1024'))
+
+# NOTE: attention implementation of the VQGAN encoder and decoder, one of
+# "vanilla", "chunked" or "sdpa", see `difussion_models.AttnBlock`. "sdpa"
+# needs torch >= 2.0 and falls back to "chunked" otherwise
+TAMING_ATTENTION_TYPE = os.getenv('TAMING_ATTENTION_TYPE', 'sdpa')
+
+# NOTE: recompute the generator activations in the backward pass instead of
+# storing them, trading compute for memory so more jobs fit in RAM. With a
+# budget (in MB per sample) only the largest segments are recomputed
+ACTIVATION_CHECKPOINTING = os.getenv('ACTIVATION_CHECKPOINTING', '0') == '1'
+ACTIVATION_MEMORY_BUDGET_MB = os.getenv('ACTIVATION_MEMORY_BUDGET_MB')
+if ACTIVATION_MEMORY_BUDGET_MB is not None:
+    ACTIVATION_MEMORY_BUDGET_MB = float(ACTIVATION_MEMORY_BUDGET_MB)
+
+# NOTE: models resident in this worker process, filled once at startup so
+# that jobs borrow them instead of reloading CLIP and the generator weights
+_model_registry = {}
+
+
+def load_model(
+    model_name: str,
+    warmup: bool = True,
+):
+    if model_name in _model_registry:
+        return _model_registry[model_name]
+
+    print(f"Loading {model_name}...")
+    if model_name == 'aphantasia':
+        from models import aphantasia
+        model = aphantasia
+    elif model_name == 'stylegan':
+        from models.stylegan import StyleGAN
+        model = StyleGAN(
+            loss_resolution=STYLEGAN_LOSS_RESOLUTION,
+            activation_checkpointing=ACTIVATION_CHECKPOINTING,
+            activation_memory_budget_mb=ACTIVATION_MEMORY_BUDGET_MB,
+        )
+    elif model_name == 'taming':
+        from models.taming.taming_decoder import TamingDecoder
+        model = TamingDecoder(
+            attn_type=TAMING_ATTENTION_TYPE,
+            activation_checkpointing=ACTIVATION_CHECKPOINTING,
+            activation_memory_budget_mb=ACTIVATION_MEMORY_BUDGET_MB,
+        )
+    else:
+        raise ValueError(f"MODEL {model_name} NOT RECOGNIZED")
+
+    # NOTE: aphantasia only loads its CLIP model on warmup, it is loaded here
+    # for every model so that it is resident, and shared by a supervisor,
+    # before any warmup
+    from models.clip_utils import load_clip
+    load_clip(CLIP_MODEL_NAME)
+
+    if warmup:
+        print(f"Warming up {model_name}...")
+        model.warmup()
+
+    _model_registry[model_name] = model
+
+    return model
+
+
+def load_models(
+    model_list: List[str] = MODEL_LIST,
+    warmup: bool = True,
+):
+    for model_name in model_list:
+        load_model(model_name, warmup=warmup)
+
+
+def warmup_models(model_list: List[str] = MODEL_LIST, ):
+    for model_name in model_list:
+        print(f"Warming up {model_name}...")
+        _model_registry[model_name].warmup()
+
+
+def get_resident_module_list():
+    """
+    Modules holding the weights of the resident models, as listed by their
+    `shared_modules`. Modules shared by several models, like CLIP, are only
+    listed once.
+    """
+    module_dict = {}
+    for model in _model_registry.values():
+        for module in model.shared_modules():
+            module_dict[id(module)] = module
+
+    return list(module_dict.values())
+
+
+def share_model_memory() -> int:
+    """
+    Moves the CPU weights of the resident models into shared memory, so the
+    worker processes forked afterwards all read the same pages instead of
+    each holding a copy. Returns the number of bytes moved.
+    """
+    num_shared_bytes = 0
+    for module in get_resident_module_list():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if tensor.device.type != 'cpu' or tensor.is_shared():
+                continue
+
+            tensor.share_memory_()
+            num_shared_bytes += tensor.numel() * tensor.element_size()
+
+    return num_shared_bytes
+
+
+def get_model(model_name: str):
+    """
+    Returns the resident model for `model_name`. Models that were not loaded
+    at worker startup are loaded on first use and kept for the next jobs.
+    """
+    return load_model(model_name, warmup=False)
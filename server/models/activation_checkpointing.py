@@ -0,0 +1,68 @@
+import inspect
+from typing import *
+
+import torch
+import torch.utils.checkpoint
+
+# NOTE: activations are float32 in every generator
+ACTIVATION_BYTES = 4
+
+
+def checkpoint_segment(
+    func: Callable,
+    *args,
+):
+    """
+    Runs `func` without storing its intermediate activations, they are
+    recomputed in the backward pass. The RNG state is restored for the
+    recomputation, so noise inputs are drawn again identically.
+    """
+    checkpoint_kwargs = {}
+    if 'use_reentrant' in inspect.signature(
+            torch.utils.checkpoint.checkpoint).parameters:
+        # NOTE: the non reentrant version supports inputs that do not require
+        # gradients, like the `None` time embeddings of the decoder
+        checkpoint_kwargs['use_reentrant'] = False
+
+    return torch.utils.checkpoint.checkpoint(
+        func,
+        *args,
+        **checkpoint_kwargs,
+    )
+
+
+def needs_recompute(*tensors) -> bool:
+    return torch.is_grad_enabled() and any(
+        tensor is not None and tensor.requires_grad for tensor in tensors)
+
+
+def get_checkpoint_mask(
+    segment_size_list: List[int],
+    memory_budget_mb: float = None,
+) -> List[bool]:
+    """
+    Segments to checkpoint given the number of activation values each one
+    stores per sample. Without `memory_budget_mb` every segment is
+    checkpointed, otherwise the largest ones are, until the activations kept
+    for the backward pass fit in the budget.
+    """
+    if memory_budget_mb is None:
+        return [True] * len(segment_size_list)
+
+    checkpoint_mask = [False] * len(segment_size_list)
+    kept_bytes = sum(segment_size_list) * ACTIVATION_BYTES
+    memory_budget = memory_budget_mb * 2**20
+
+    sorted_idx_list = sorted(
+        range(len(segment_size_list)),
+        key=lambda idx: segment_size_list[idx],
+        reverse=True,
+    )
+    for idx in sorted_idx_list:
+        if kept_bytes <= memory_budget:
+            break
+
+        checkpoint_mask[idx] = True
+        kept_bytes -= segment_size_list[idx] * ACTIVATION_BYTES
+
+    return checkpoint_mask
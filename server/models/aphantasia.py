@@ -5,6 +5,7 @@ from typing import *
 
 import numpy as np
 import torch
+import torch.fft
 import torchvision
 import torchvision.transforms.functional as TF
 import torch.nn.functional as F
@@ -12,6 +13,11 @@ import clip
 from imageio import imsave
 from PIL import Image
 
+from models.clip_utils import load_clip, warmup_clip, encode_text
+from models.session import GenerationSession, run_session
+from models.cutouts import get_stacked_random_crops, crop_and_resize
+from models.interpolation import render_interpolation
+
 model_list = ['ViT-B/32', 'RN50', 'RN50x4', 'RN101']
 
 img_norm = torchvision.transforms.Normalize(
@@ -129,7 +135,7 @@ def get_args():
         action='store_true',
         help='Invert criteria',
     )
-    args = parser.parse_args()
+    args, _unknown_args = parser.parse_known_args()
 
     if args.size is not None:
         args.size = [int(s) for s in args.size.split('-')][::-1]
@@ -154,34 +160,6 @@ def rfft2d_freqs(height, width):
     return np.sqrt(x_freqs * x_freqs + y_freqs * y_freqs)
 
 
-def get_fft_img(
-    spectrum_size: Union[List[int], Tuple[int]],
-    std: float = 0.01,
-    return_img_freqs=False,
-):
-    """
-    """
-    batch_size, num_channels, height, width = spectrum_size
-
-    #NOTE: generate all possible freqs for the input image size
-    img_freqs = rfft2d_freqs(height, width)
-
-    #NOTE: 2 for imaginary and real components
-    spectrum_shape = [
-        batch_size,
-        num_channels,
-        *img_freqs.shape,
-        2,
-    ]
-
-    fft_img = (torch.randn(*spectrum_shape) * std)
-
-    if return_img_freqs:
-        return fft_img, img_freqs
-    else:
-        return fft_img
-
-
 def get_scale_from_img_freqs(
     img_freqs,
     decay_power,
@@ -196,98 +174,247 @@ def get_scale_from_img_freqs(
     return scale
 
 
-def fft_to_rgb(
-    fft_img,
-    scale,
-    img_size,
-    shift=None,
-    contrast=1.,
-    decorrelate=True,
-    device="cuda",
-):
-    num_channels = 3
-    im = 2
+def get_color_correlation_matrix(colors: float = 1., ):
+    """
+    Matrix decorrelating the colors of the image, transposed to be applied on
+    the channel dimension.
+    """
+    color_correlation_svd_sqrt = np.asarray([
+        [0.26, 0.09, 0.02],
+        [0.27, 0.00, -0.05],
+        [0.27, -0.09, 0.03],
+    ]).astype("float32")
+    color_correlation_svd_sqrt /= np.asarray([
+        colors,
+        1.,
+        1.,
+    ])  # saturate, empirical
 
-    scaled_fft_img = scale * fft_img
-    if shift is not None:
-        scaled_fft_img += scale * shift
+    max_norm_svd_sqrt = np.max(
+        np.linalg.norm(color_correlation_svd_sqrt, axis=0))
+
+    color_correlation_normalized = color_correlation_svd_sqrt / max_norm_svd_sqrt
+
+    return torch.tensor(color_correlation_normalized.T)
 
-    image = torch.irfft(
-        scaled_fft_img,
-        im,
-        normalized=True,
-        signal_sizes=img_size,
-    )
-    image = image * contrast / image.std()  # keep contrast, empirical
 
-    if decorrelate:
-        colors = 1
-        color_correlation_svd_sqrt = np.asarray([
-            [0.26, 0.09, 0.02],
-            [0.27, 0.00, -0.05],
-            [0.27, -0.09, 0.03],
-        ]).astype("float32")
-        color_correlation_svd_sqrt /= np.asarray([
-            colors,
-            1.,
-            1.,
-        ])  # saturate, empirical
+class FFTImage(torch.nn.Module):
+    """
+    Decodes batches of spectra of shape `B x 3 x H x (W // 2 + 1) x 2` (real
+    and imaginary parts) into RGB images of size `img_size`. The frequency
+    scale and the color matrix are buffers built once per image size.
+    """
+    def __init__(
+        self,
+        img_size: Tuple[int, int],
+        decay_power: float = 1.,
+        colors: float = 1.,
+        decorrelate: bool = True,
+    ):
+        super().__init__()
+        self.img_size = tuple(img_size)
+        self.decorrelate = decorrelate
+
+        img_freqs = rfft2d_freqs(*self.img_size)
+        self.spectrum_size = img_freqs.shape
+
+        self.register_buffer(
+            'scale',
+            get_scale_from_img_freqs(
+                img_freqs=img_freqs,
+                decay_power=decay_power,
+            ),
+        )
+        self.register_buffer(
+            'color_matrix',
+            get_color_correlation_matrix(colors),
+        )
 
-        max_norm_svd_sqrt = np.max(
-            np.linalg.norm(color_correlation_svd_sqrt, axis=0))
+    def init_spectrum(
+        self,
+        batch_size: int = 1,
+        std: float = 0.01,
+    ):
+        num_channels = 3
+
+        #NOTE: 2 for imaginary and real components
+        return torch.randn(
+            batch_size,
+            num_channels,
+            *self.spectrum_size,
+            2,
+            device=self.scale.device,
+        ) * std
+
+    def forward(
+        self,
+        fft_img,
+        shift=None,
+        contrast: float = 1.,
+    ):
+        scaled_fft_img = self.scale * fft_img
+        if shift is not None:
+            scaled_fft_img = scaled_fft_img + self.scale * shift
+
+        image = torch.fft.irfftn(
+            torch.view_as_complex(scaled_fft_img),
+            s=self.img_size,
+            dim=(-2, -1),
+            norm='ortho',
+        )
+        # NOTE: per sample so that batched images do not affect each other
+        image = image * contrast / image.std(
+            dim=(1, 2, 3),
+            keepdim=True,
+        )  # keep contrast, empirical
 
-        color_correlation_normalized = color_correlation_svd_sqrt / max_norm_svd_sqrt
+        if self.decorrelate:
+            image = torch.einsum('bchw,cd->bdhw', image, self.color_matrix)
 
-        image_permute = image.permute(0, 2, 3, 1)
-        image_permute = torch.matmul(
-            image_permute,
-            torch.tensor(color_correlation_normalized.T).to(device))
+        image = torch.sigmoid(image)
 
-        image = image_permute.permute(0, 3, 1, 2)
+        return image
 
-    image = torch.sigmoid(image)
 
-    return image
+# NOTE: shared by every session with the same image size
+_fft_image_cache = {}
 
 
-def checkout(
-    img,
-    fname=None,
+def get_fft_image(
+    img_size: Tuple[int, int],
+    decay_power: float = 1.,
+    device: str = 'cpu',
 ):
-    img = np.transpose(np.array(img)[:, :, :], (1, 2, 0))
-    if fname is not None:
-        img = np.clip(img * 255, 0, 255).astype(np.uint8)
-        imsave(fname, img)
+    key = (tuple(img_size), decay_power, str(device))
+    if key not in _fft_image_cache:
+        _fft_image_cache[key] = FFTImage(
+            img_size,
+            decay_power=decay_power,
+        ).to(device)
 
+    return _fft_image_cache[key]
 
-def get_stacked_random_crops(img, num_random_crops=64):
-    crop_trans = torchvision.transforms.RandomCrop(img.shape[2:4])
-    img = crop_trans(img)
-    img_size = [img.shape[2], img.shape[3]]
 
-    crop_list = []
-    for _ in range(num_random_crops):
-        crop_size_y = int(img_size[0] * torch.zeros(1, ).uniform_(.2, .8))
-        crop_size_x = int(img_size[1] * torch.zeros(1, ).uniform_(.2, .8))
+def fft_imgs_to_pil(img):
+    """
+    Converts a batch of images in [0, 1] into a single PIL image, with the
+    samples of the batch side by side.
+    """
+    img = img.detach().cpu().numpy()
+    img = np.concatenate(np.transpose(img, (0, 2, 3, 1)), axis=1)
+    img = np.clip(img * 255, 0, 255).astype(np.uint8)
 
-        y_offset = torch.randint(0, img_size[0] - crop_size_y, ())
-        x_offset = torch.randint(0, img_size[1] - crop_size_x, ())
+    return Image.fromarray(img)
 
-        crop = img[:, :, y_offset:y_offset + crop_size_y,
-                   x_offset:x_offset + crop_size_x]
 
-        crop = torch.nn.functional.upsample_bilinear(crop, (224, 224))
-        # crop = torch.nn.functional.interpolate(
-        #     crop,
-        #     (224, 224),
-        #     mode='bilinear',
-        # )
+def resize_spectrum(
+    fft_img,
+    src_fft_image: FFTImage,
+    dst_fft_image: FFTImage,
+):
+    """
+    Zero pads a spectrum of `src_fft_image` into the higher frequency bins of
+    the larger spectrum of `dst_fft_image`. The coefficients are rescaled so
+    that both modules decode the same image, upsampled.
+    """
+    src_height, src_width = src_fft_image.spectrum_size
+    dst_height, dst_width = dst_fft_image.spectrum_size
+    # NOTE: `fftfreq` puts the non-negative frequencies first
+    num_pos_freqs = (src_height + 1) // 2
+    num_neg_freqs = src_height // 2
+
+    scaled_fft_img = src_fft_image.scale * fft_img
+    dst_scale = dst_fft_image.scale[0, 0]
+
+    resized_fft_img = torch.zeros(
+        *fft_img.shape[:2],
+        dst_height,
+        dst_width,
+        fft_img.shape[-1],
+        device=fft_img.device,
+        dtype=fft_img.dtype,
+    )
+    resized_fft_img[:, :, :num_pos_freqs, :src_width] = (
+        scaled_fft_img[:, :, :num_pos_freqs] /
+        dst_scale[:num_pos_freqs, :src_width])
+    resized_fft_img[:, :, dst_height - num_neg_freqs:, :src_width] = (
+        scaled_fft_img[:, :, src_height - num_neg_freqs:] /
+        dst_scale[dst_height - num_neg_freqs:, :src_width])
+
+    return resized_fft_img
+
+
+def get_resolution_schedule(
+    img_size: Tuple[int, int],
+    num_steps: int,
+    num_resolution_stages: int = 1,
+    min_size: int = 224,
+):
+    """
+    Coarse to fine schedule as a list of `(start_step, size)`. Every stage
+    doubles the size of the previous one and runs for the same number of
+    steps, the last one at `img_size`. Stages smaller than `min_size` (the
+    CLIP input) are skipped.
+    """
+    size_list = []
+    for stage_idx in range(num_resolution_stages):
+        downscale = 2**(num_resolution_stages - 1 - stage_idx)
+        if downscale > 1 and min(img_size) // downscale < min_size:
+            continue
+        size_list.append(tuple(dim // downscale for dim in img_size))
+
+    return [(num_steps * idx // len(size_list), size)
+            for idx, size in enumerate(size_list)]
+
 
-        crop_list.append(crop)
+def update_session_resolution(session: GenerationSession, ):
+    """
+    Moves the session to the size its resolution schedule sets for the
+    current step, carrying the optimized spectrum over.
+    """
+    size = [
+        size for start_step, size in session.extra['resolution_schedule']
+        if start_step <= session.step
+    ][-1]
+
+    fft_image = session.extra['fft_image']
+    if size == fft_image.img_size:
+        return
+
+    print(f"Growing resolution to {size}")
+    new_fft_image = get_fft_image(
+        size,
+        decay_power=session.extra['decay'],
+        device=session.extra['device'],
+    )
 
-    img = torch.cat(crop_list, axis=0)
+    with torch.no_grad():
+        fft_img = resize_spectrum(session.latents, fft_image, new_fft_image)
+        if session.extra['shift'] is not None:
+            session.extra['shift'] = resize_spectrum(
+                session.extra['shift'],
+                fft_image,
+                new_fft_image,
+            )
+    fft_img.requires_grad = True
 
-    return img
+    # NOTE: SGD without momentum has no state to carry over
+    session.optimizer = torch.optim.SGD(
+        [fft_img],
+        session.optimizer.param_groups[0]['lr'],
+    )
+    session.latents = fft_img
+    session.extra['fft_image'] = new_fft_image
+
+
+def checkout(
+    img,
+    fname=None,
+):
+    img = np.transpose(np.array(img)[:, :, :], (1, 2, 0))
+    if fname is not None:
+        img = np.clip(img * 255, 0, 255).astype(np.uint8)
+        imsave(fname, img)
 
 
 def random_crop(
@@ -306,38 +433,61 @@ def random_crop(
     img_size = img.shape[2:]
     min_img_size = min(img_size)
 
-    sliced = []
-    cuts = []
-    for c in range(num_crops):
-        current_crop_size = map(rnd_size[c], crop_size, min_img_size).int()
+    current_crop_size = map(rnd_size, crop_size, min_img_size).int()
+    offsetx = map(rnd_offx, 0, img_size[1] - current_crop_size).int()
+    offsety = map(rnd_offy, 0, img_size[0] - current_crop_size).int()
+
+    box_tensor = torch.stack(
+        [offsety, offsetx, current_crop_size, current_crop_size],
+        -1,
+    ).float()
+    # NOTE: bilinear, `grid_sample` has no bicubic mode before torch 1.8
+    cuts = crop_and_resize(
+        img,
+        box_tensor,
+        crop_size=crop_size,
+        align_corners=False,
+    )
 
-        offsetx = map(rnd_offx[c], 0, img_size[1] - current_crop_size).int()
-        offsety = map(rnd_offy[c], 0, img_size[0] - current_crop_size).int()
-        cut = img[:, :, offsety:offsety + current_crop_size,
-                  offsetx:offsetx + current_crop_size]
-        cut = F.interpolate(
-            cut,
-            (crop_size, crop_size),
-            mode='bicubic',
-            align_corners=False,
-        )  # bilinear
+    if normalize is not None:
+        cuts = img_norm(cuts)
 
-        if normalize is not None:
-            cut = img_norm(cut)
+    return cuts
 
-        cuts.append(cut)
 
-    return torch.cat(cuts, axis=0)
+def shared_modules(model_name: str = 'ViT-B/32', ):
+    """
+    Modules holding the weights of the model, only CLIP since the spectra
+    are per session. See `model_utils.share_model_memory`.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    clip_model, _ = load_clip(model_name, device=device)
 
+    return [clip_model]
 
-def generate_from_prompt(
+
+def warmup(model_name: str = 'ViT-B/32', ):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    clip_model, _ = load_clip(model_name, device=device)
+    warmup_clip(clip_model, device=device)
+
+
+def init_session(
     prompt: str,
     lr: float = 3e-1,
     img_save_freq: int = 1,
     num_generations: int = 200,
     num_random_crops: int = 20,
     resolution: str = "1024-1024",
+    batch_size: int = 1,
+    num_resolution_stages: int = 1,
 ):
+    """
+    With `batch_size` above 1 the session optimizes that many variations of
+    the prompt together, its frames show them side by side. With
+    `num_resolution_stages` above 1 the spectrum starts at a fraction of the
+    resolution and is grown to it during the optimization.
+    """
     args = get_args()
     device = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -350,41 +500,30 @@ def generate_from_prompt(
     if resolution is not None:
         args.size = tuple([int(res) for res in resolution.split("-")])
 
-    gen_img_list = []
-    gen_fft_list = []
-
-    clip_model, _ = clip.load(args.model)
     print(f"Using model {args.model}")
 
     input_text = args.input_text
     print(f"Generating from '{input_text}'")
 
-    tokenized_text = clip.tokenize([input_text]).to(device).detach().clone()
-    text_logits = clip_model.encode_text(tokenized_text)
+    text_logits = encode_text(input_text, model_name=args.model, device=device)
 
-    num_channels = 3
-    spectrum_size = [args.batch_size, num_channels, *args.size]
-    fft_img, img_freqs = get_fft_img(
-        spectrum_size,
-        std=0.01,
-        return_img_freqs=True,
+    resolution_schedule = get_resolution_schedule(
+        args.size,
+        args.num_steps,
+        num_resolution_stages=num_resolution_stages,
     )
-
-    fft_img = fft_img.to(device)
-    fft_img.requires_grad = True
-
-    scale = get_scale_from_img_freqs(
-        img_freqs=img_freqs,
+    fft_image = get_fft_image(
+        resolution_schedule[0][1],
         decay_power=args.decay,
+        device=device,
     )
-
-    scale = scale.to(device)
+    fft_img = fft_image.init_spectrum(batch_size=batch_size, std=0.01)
+    fft_img.requires_grad = True
 
     shift = None
     if args.noise > 0:
-        img_size = img_freqs.shape
-        noise_size = (1, 1, *img_size, 1)
-        shift = self.noise * torch.randn(noise_size, ).to(self.device)
+        noise_size = (1, 1, *fft_image.spectrum_size, 1)
+        shift = args.noise * torch.randn(noise_size, ).to(device)
 
     # optimizer = torch.optim.Adam(
     #     [fft_img],
@@ -395,78 +534,236 @@ def generate_from_prompt(
         args.lrate,
     )
 
-    for step in range(args.num_steps):
-        loss = 0
+    session = GenerationSession(
+        prompt=prompt,
+        latents=fft_img,
+        optimizer=optimizer,
+        text_logits=text_logits,
+        num_steps=args.num_steps,
+        img_save_freq=args.save_freq,
+    )
+    session.extra = {
+        'model': args.model,
+        'size': tuple(args.size),
+        'fft_image': fft_image,
+        'resolution_schedule': resolution_schedule,
+        # NOTE: the optimization cannot be converged before the last stage
+        'min_converged_step': resolution_schedule[-1][0],
+        'decay': args.decay,
+        'shift': shift,
+        'num_random_crops': args.num_random_crops,
+        'device': device,
+        # NOTE: shape of the spectrum at the end of the resolution schedule
+        'final_latent_shape': (
+            batch_size,
+            3,
+            *get_fft_image(args.size, args.decay, device).spectrum_size,
+            2,
+        ),
+    }
+
+    return session
+
+
+def warm_start_session(
+    session: GenerationSession,
+    latents,
+    noise_frac: float = 0.,
+):
+    """
+    Starts `session` from the final spectrum of a previous session, blended
+    with a `noise_frac` fraction of its own initialization. The spectrum is
+    already at full resolution, so the coarse stages are skipped.
+    """
+    fft_image = session.extra['fft_image']
+    final_fft_image = get_fft_image(
+        session.extra['size'],
+        decay_power=session.extra['decay'],
+        device=session.extra['device'],
+    )
 
-        initial_img = fft_to_rgb(
-            fft_img=fft_img,
-            scale=scale,
-            img_size=args.size,
-            shift=shift,
-            contrast=1.0,
-            decorrelate=True,
-            device=device,
-        )
+    with torch.no_grad():
+        init_fft_img = session.latents
+        shift = session.extra['shift']
+        if final_fft_image is not fft_image:
+            init_fft_img = resize_spectrum(
+                init_fft_img,
+                fft_image,
+                final_fft_image,
+            )
+            if shift is not None:
+                shift = resize_spectrum(shift, fft_image, final_fft_image)
 
-        # crop_img_out = random_crop(
-        #     initial_img,
-        #     num_crops,
-        #     crop_size,
-        #     normalize=True,
-        # )
-        crop_img_out = get_stacked_random_crops(
-            initial_img,
-            num_random_crops,
-        )
-        img_logits = clip_model.encode_image(crop_img_out).to(device)
-        tokenized_text = clip.tokenize([input_text]).to(device)
-        text_logits = clip_model.encode_text(tokenized_text)
-
-        loss += -10 * torch.cosine_similarity(
-            text_logits,
-            img_logits,
-            dim=-1,
-        ).mean()
-
-        print(loss)
-
-        # torch.cuda.empty_cache()
-
-        # if self.prog is True:
-        #     lr_cur = lr + (step / self.steps) * (init_lr - lr)
-        #     for g in self.optimizer.param_groups:
-        #         g['lr'] = lr_cur
-
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-
-        if step % args.save_freq == 0:
-            print("Saving generation...")
-            with torch.no_grad():
-                img = fft_to_rgb(
-                    fft_img=fft_img,
-                    scale=scale,
-                    img_size=args.size,
-                    shift=shift,
-                    contrast=1.0,
-                    decorrelate=True,
-                    device=device,
+        fft_img = (1 - noise_frac) * latents.to(
+            init_fft_img.device) + noise_frac * init_fft_img
+    fft_img.requires_grad = True
+
+    session.optimizer = torch.optim.SGD(
+        [fft_img],
+        session.optimizer.param_groups[0]['lr'],
+    )
+    session.latents = fft_img
+    session.extra['fft_image'] = final_fft_image
+    session.extra['shift'] = shift
+    session.extra['resolution_schedule'] = [(0, session.extra['size'])]
+    session.extra['min_converged_step'] = 0
+
+
+def batched_step(session_list: List[GenerationSession], ):
+    """
+    Runs one optimization step for all the sessions. The sessions must share
+    the CLIP model, the image size and the number of crops, sessions at the
+    same stage of their resolution schedule are stepped together.
+    """
+    size_session_dict = {}
+    for session in session_list:
+        update_session_resolution(session)
+        size = session.extra['fft_image'].img_size
+        size_session_dict.setdefault(size, []).append(session)
+
+    for size_session_list in size_session_dict.values():
+        step_same_size(size_session_list)
+
+
+def step_same_size(session_list: List[GenerationSession], ):
+    session_extra = session_list[0].extra
+    clip_model, _ = load_clip(
+        session_extra['model'],
+        device=session_extra['device'],
+    )
+
+    fft_img = torch.cat([session.latents for session in session_list])
+    text_logits = torch.cat([
+        session.text_logits.expand(session.latents.shape[0], -1)
+        for session in session_list
+    ])
+
+    fft_image = session_extra['fft_image']
+    initial_img = fft_image(fft_img, shift=session_extra['shift'])
+
+    # crop_img_out = random_crop(
+    #     initial_img,
+    #     num_crops,
+    #     crop_size,
+    #     normalize=True,
+    # )
+    crop_img_out = get_stacked_random_crops(
+        initial_img,
+        session_extra['num_random_crops'],
+    )
+    img_logits = clip_model.encode_image(crop_img_out)
+    img_logits = img_logits.view(-1, fft_img.shape[0], img_logits.shape[-1])
+
+    sample_loss = -10 * torch.cosine_similarity(
+        text_logits[None],
+        img_logits,
+        dim=-1,
+    ).mean(0)
+
+    split_size_list = [session.latents.shape[0] for session in session_list]
+    session_loss_list = [
+        session_sample_loss.mean()
+        for session_sample_loss in sample_loss.split(split_size_list)
+    ]
+
+    # torch.cuda.empty_cache()
+
+    # if self.prog is True:
+    #     lr_cur = lr + (step / self.steps) * (init_lr - lr)
+    #     for g in self.optimizer.param_groups:
+    #         g['lr'] = lr_cur
+
+    for session in session_list:
+        session.optimizer.zero_grad()
+
+    torch.stack(session_loss_list).sum().backward()
+
+    save_session_list = []
+    for session, session_loss in zip(session_list, session_loss_list):
+        session.optimizer.step()
+        session.loss = session_loss.item()
+        print(f"Loss {session.loss}")
+
+        if session.step % session.img_save_freq == 0:
+            save_session_list.append(session)
+
+        session.step += 1
+
+    if len(save_session_list) > 0:
+        print("Saving generation...")
+        with torch.no_grad():
+            img = fft_image(
+                torch.cat([session.latents for session in save_session_list]),
+                shift=session_extra['shift'],
+            )
+
+        img_list = img.split(
+            [session.latents.shape[0] for session in save_session_list])
+        for session, session_img in zip(save_session_list, img_list):
+            session_feat = session.latents.detach()
+            session_pil_img = fft_imgs_to_pil(session_img)
+
+            # NOTE: frames and features always have the final resolution
+            if fft_image.img_size != session.extra['size']:
+                img_height, img_width = session.extra['size']
+                session_pil_img = session_pil_img.resize(
+                    (img_width * session_img.shape[0], img_height),
+                    Image.BICUBIC,
+                )
+                session_feat = resize_spectrum(
+                    session_feat,
+                    fft_image,
+                    get_fft_image(
+                        session.extra['size'],
+                        decay_power=session.extra['decay'],
+                        device=session.extra['device'],
+                    ),
                 )
-                img = img.detach().cpu().numpy()[0]
-                img = np.transpose(np.array(img)[:, :, :], (1, 2, 0))
-                img = np.clip(img * 255, 0, 255).astype(np.uint8)
-                pil_img = Image.fromarray(img)
-                gen_img_list.append(pil_img)
-                gen_fft_list.append(fft_img)
 
-    return gen_img_list, gen_fft_list
+            session.add_frame(session_pil_img)
+            session.add_feat(session_feat)
+
+
+def generate_from_prompt(
+    prompt: str,
+    lr: float = 3e-1,
+    img_save_freq: int = 1,
+    num_generations: int = 200,
+    num_random_crops: int = 20,
+    resolution: str = "1024-1024",
+    batch_size: int = 1,
+    num_resolution_stages: int = 1,
+    callback_list: List[Callable] = None,
+    frame_sink_list: List = None,
+    keep_all_frames: bool = True,
+):
+    session = init_session(
+        prompt=prompt,
+        lr=lr,
+        img_save_freq=img_save_freq,
+        num_generations=num_generations,
+        num_random_crops=num_random_crops,
+        resolution=resolution,
+        batch_size=batch_size,
+        num_resolution_stages=num_resolution_stages,
+    )
+
+    if callback_list is not None:
+        session.callback_list = callback_list
+    if frame_sink_list is not None:
+        session.frame_sink_list = frame_sink_list
+    session.keep_all_frames = keep_all_frames
+
+    return run_session(batched_step, session)
 
 
 def interpolate(
     fft_img_list,
     duration_list,
     resolution=None,
+    frame_sink_list: List = None,
+    keep_all_frames: bool = True,
+    should_stop: Callable = None,
 ):
     args = get_args()
 
@@ -474,49 +771,20 @@ def interpolate(
 
     args.size = tuple([int(res) for res in resolution.split("-")])
 
-    num_channels = 3
-    spectrum_size = [args.batch_size, num_channels, *args.size]
-    fft_img, img_freqs = get_fft_img(
-        spectrum_size,
-        std=0.01,
-        return_img_freqs=True,
-    )
-
-    scale = get_scale_from_img_freqs(
-        img_freqs=img_freqs,
+    fft_image = get_fft_image(
+        args.size,
         decay_power=args.decay,
+        device=device,
     )
-    scale = scale.to(device)
-
-    gen_img_list = []
-    fps = 25
-
-    for idx, (fft_img, duration) in enumerate(zip(fft_img_list,
-                                                  duration_list)):
-        num_steps = int(duration * fps)
-        fft_img_1 = fft_img
-        fft_img_2 = fft_img_list[(idx + 1) % len(fft_img_list)]
-
-        for step in range(num_steps):
-            weight = math.sin(1.5708 * step / num_steps)**2
-            fft_img_interp = weight * fft_img_2 + (1 - weight) * fft_img_1
-            img = fft_to_rgb(
-                fft_img=fft_img_interp,
-                scale=scale,
-                img_size=args.size,
-                shift=None,
-                contrast=1.0,
-                decorrelate=True,
-                device=device,
-            )
-            img = img.detach().cpu().numpy()[0]
-            img = np.transpose(np.array(img)[:, :, :], (1, 2, 0))
-            img = np.clip(img * 255, 0, 255).astype(np.uint8)
-            pil_img = Image.fromarray(img)
 
-            gen_img_list.append(pil_img)
-
-    return gen_img_list
+    return render_interpolation(
+        fft_img_list,
+        duration_list,
+        decode=fft_image,
+        frame_sink_list=frame_sink_list,
+        keep_all_frames=keep_all_frames,
+        should_stop=should_stop,
+    )
 
 
 if __name__ == '__main__':
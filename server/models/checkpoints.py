@@ -0,0 +1,52 @@
+import os
+import uuid
+import inspect
+from typing import *
+
+import torch
+
+
+def save_state_dict_file(
+    state_dict: Dict[str, torch.Tensor],
+    path: str,
+):
+    """
+    Writes `state_dict` atomically, so a process killed halfway never leaves
+    a truncated file behind. Every writer uses its own temporary file, so
+    processes writing the same path at once cannot mix their contents.
+    """
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_state_dict_file(path: str, ):
+    """
+    Memory maps the file when torch supports it (>= 2.1), so tensors are only
+    read from disk when they are used.
+    """
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location="cpu", mmap=True)
+
+    return torch.load(path, map_location="cpu")
+
+
+def load_weights(
+    model: torch.nn.Module,
+    state_dict: Dict[str, torch.Tensor],
+    strict: bool = True,
+):
+    load_kwargs = {}
+    if 'assign' in inspect.signature(model.load_state_dict).parameters:
+        # NOTE: keeps the memory mapped tensors instead of copying them
+        load_kwargs['assign'] = True
+
+    return model.load_state_dict(
+        state_dict,
+        strict=strict,
+        **load_kwargs,
+    )
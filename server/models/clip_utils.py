@@ -0,0 +1,195 @@
+import os
+import hashlib
+from collections import OrderedDict
+from typing import *
+
+import numpy as np
+import torch
+import clip
+
+_clip_model_dict = {}
+
+
+def get_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def load_clip(
+    model_name: str = "ViT-B/32",
+    device: str = None,
+):
+    """
+    Returns the `(clip_model, clip_preprocess)` pair for `model_name`, loading
+    it only the first time it is requested in this process. The weights are
+    frozen since every generator only optimizes its own latents.
+    """
+    if device is None:
+        device = get_device()
+
+    model_key = (model_name, device)
+    if model_key not in _clip_model_dict:
+        print(f"Loading CLIP {model_name} on {device}")
+        clip_model, clip_preprocess = clip.load(
+            model_name,
+            device=device,
+        )
+        clip_model.eval()
+        clip_model.requires_grad_(False)
+
+        _clip_model_dict[model_key] = (clip_model, clip_preprocess)
+
+    return _clip_model_dict[model_key]
+
+
+def warmup_clip(
+    clip_model,
+    device: str = None,
+    img_size: int = 224,
+):
+    if device is None:
+        device = get_device()
+
+    with torch.no_grad():
+        tokenized_text = clip.tokenize([""]).to(device)
+        clip_model.encode_text(tokenized_text)
+
+        img = torch.zeros((1, 3, img_size, img_size)).to(device)
+        clip_model.encode_image(img)
+
+
+class TextEmbeddingCache:
+    """
+    Normalized CLIP text embeddings keyed by `(model_name, prompt)`. Lookups
+    go through an in-process LRU first and then through an optional shared
+    layer (a Redis connection or a directory on disk) so that a prompt is
+    encoded once for every worker sharing it.
+    """
+    def __init__(
+        self,
+        max_size: int = 256,
+        redis_conn=None,
+        cache_dir: str = None,
+        ttl: int = 7 * 24 * 3600,
+    ):
+        self.max_size = max_size
+        self.redis_conn = redis_conn
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+        self.lru_dict = OrderedDict()
+
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(
+        model_name: str,
+        prompt: str,
+    ):
+        prompt_hash = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        model_name = model_name.replace('/', '-')
+
+        return f"clip-text:{model_name}:{prompt_hash}"
+
+    def get(
+        self,
+        model_name: str,
+        prompt: str,
+    ):
+        key = self.get_key(model_name, prompt)
+
+        if key in self.lru_dict:
+            self.lru_dict.move_to_end(key)
+            return self.lru_dict[key]
+
+        embedding_bytes = None
+        if self.redis_conn is not None:
+            embedding_bytes = self.redis_conn.get(key)
+        elif self.cache_dir is not None:
+            embedding_path = os.path.join(self.cache_dir, f"{key}.npy")
+            if os.path.exists(embedding_path):
+                with open(embedding_path, 'rb') as f:
+                    embedding_bytes = f.read()
+
+        if embedding_bytes is None:
+            return None
+
+        embedding = torch.from_numpy(
+            np.frombuffer(embedding_bytes, dtype=np.float32).copy())
+        self._add_to_lru(key, embedding)
+
+        return embedding
+
+    def put(
+        self,
+        model_name: str,
+        prompt: str,
+        embedding: torch.Tensor,
+    ):
+        key = self.get_key(model_name, prompt)
+        embedding = embedding.detach().float().cpu().flatten()
+        self._add_to_lru(key, embedding)
+
+        embedding_bytes = embedding.numpy().tobytes()
+        if self.redis_conn is not None:
+            self.redis_conn.set(key, embedding_bytes, ex=self.ttl)
+        elif self.cache_dir is not None:
+            embedding_path = os.path.join(self.cache_dir, f"{key}.npy")
+            with open(f"{embedding_path}.tmp", 'wb') as f:
+                f.write(embedding_bytes)
+            os.replace(f"{embedding_path}.tmp", embedding_path)
+
+    def _add_to_lru(
+        self,
+        key: str,
+        embedding: torch.Tensor,
+    ):
+        self.lru_dict[key] = embedding
+        self.lru_dict.move_to_end(key)
+        while len(self.lru_dict) > self.max_size:
+            self.lru_dict.popitem(last=False)
+
+
+text_embedding_cache = TextEmbeddingCache(
+    cache_dir=os.getenv('CLIP_TEXT_CACHE_DIR'), )
+
+
+def set_text_embedding_backend(
+    redis_conn=None,
+    cache_dir: str = None,
+):
+    text_embedding_cache.redis_conn = redis_conn
+    text_embedding_cache.cache_dir = cache_dir
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+def encode_text(
+    prompt: str,
+    model_name: str = "ViT-B/32",
+    device: str = None,
+):
+    """
+    Returns the normalized `(1, embed_dim)` CLIP embedding of `prompt`, only
+    running the text encoder when the prompt is not cached yet.
+    """
+    if device is None:
+        device = get_device()
+
+    clip_model, _ = load_clip(model_name, device=device)
+
+    text_logits = text_embedding_cache.get(model_name, prompt)
+    if text_logits is None:
+        with torch.no_grad():
+            tokenized_text = clip.tokenize([prompt]).to(device)
+            text_logits = clip_model.encode_text(tokenized_text).float()
+            text_logits = text_logits / text_logits.norm(dim=-1, keepdim=True)
+
+        text_embedding_cache.put(model_name, prompt, text_logits)
+
+    text_logits = text_logits.view(1, -1).to(
+        device=device,
+        dtype=clip_model.dtype,
+    )
+
+    return text_logits
@@ -0,0 +1,84 @@
+from typing import *
+
+
+class ConvergenceMonitor:
+    """
+    Tracks an exponential moving average of the CLIP loss and detects when
+    the optimization plateaus: the average improving by less than
+    `min_improvement` (relative to its magnitude) for `patience` steps in a
+    row. The maximum number of steps is still set by the caller.
+
+    Used as a session callback it ends the session once converged, loops
+    without sessions call `update` directly.
+    """
+    def __init__(
+        self,
+        ema_decay: float = .9,
+        min_improvement: float = 1e-3,
+        patience: int = 10,
+        min_steps: int = 20,
+        stop_on_convergence: bool = True,
+    ):
+        self.ema_decay = ema_decay
+        self.min_improvement = min_improvement
+        self.patience = patience
+        self.min_steps = min_steps
+        self.stop_on_convergence = stop_on_convergence
+
+        self.num_steps = 0
+        self.reset()
+
+    def reset(self, ):
+        self.loss_ema = None
+        self.num_tracked_steps = 0
+        self.num_stalled_steps = 0
+        self.latent_shape = None
+
+    def update(self, loss: float, ) -> bool:
+        """
+        Adds the loss of a step, returns whether the optimization converged.
+        """
+        self.num_steps += 1
+        self.num_tracked_steps += 1
+
+        if self.loss_ema is None:
+            self.loss_ema = loss
+            return False
+
+        prev_loss_ema = self.loss_ema
+        self.loss_ema = self.ema_decay * self.loss_ema + (
+            1 - self.ema_decay) * loss
+
+        improvement = prev_loss_ema - self.loss_ema
+        if improvement < self.min_improvement * abs(prev_loss_ema):
+            self.num_stalled_steps += 1
+        else:
+            self.num_stalled_steps = 0
+
+        if not self.stop_on_convergence:
+            return False
+
+        return self.num_tracked_steps >= self.min_steps and \
+            self.num_stalled_steps >= self.patience
+
+    def __call__(self, session):
+        if session.loss is None:
+            return
+
+        # NOTE: the loss is not comparable across a change of the optimized
+        # latents, e.g. when aphantasia grows the resolution
+        latent_shape = tuple(session.latents.shape)
+        if latent_shape != self.latent_shape:
+            num_steps = self.num_steps
+            self.reset()
+            self.num_steps = num_steps
+            self.latent_shape = latent_shape
+
+        converged = self.update(session.loss)
+
+        # NOTE: sessions can forbid stopping before a given step, e.g. before
+        # reaching their final resolution
+        if converged and session.step >= session.extra.get(
+                'min_converged_step', 0):
+            print(f"Converged after {session.step} steps")
+            session.converged = True
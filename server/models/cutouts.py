@@ -0,0 +1,138 @@
+from typing import *
+
+import torch
+import torch.nn.functional as F
+
+
+def get_crop_theta(
+    box_tensor: torch.Tensor,
+    img_size: Tuple[int, int],
+    align_corners: bool = True,
+):
+    """
+    Affine matrices mapping the output grid of `affine_grid` onto the boxes
+    `[y_offset, x_offset, height, width]` (in pixels) of an image of size
+    `img_size`, matching the sampling positions of slicing the box and
+    resizing it with `F.interpolate` and the same `align_corners`.
+    """
+    y_offset, x_offset, height, width = box_tensor.unbind(-1)
+    img_height, img_width = img_size
+
+    if align_corners:
+        scale_y = (height - 1) / (img_height - 1)
+        scale_x = (width - 1) / (img_width - 1)
+        shift_y = (2 * y_offset + height - 1) / (img_height - 1) - 1
+        shift_x = (2 * x_offset + width - 1) / (img_width - 1) - 1
+    else:
+        scale_y = height / img_height
+        scale_x = width / img_width
+        shift_y = (2 * y_offset + height) / img_height - 1
+        shift_x = (2 * x_offset + width) / img_width - 1
+
+    zeros = torch.zeros_like(scale_x)
+    theta = torch.stack(
+        [
+            torch.stack([scale_x, zeros, shift_x], -1),
+            torch.stack([zeros, scale_y, shift_y], -1),
+        ],
+        1,
+    )
+
+    return theta
+
+
+def crop_and_resize(
+    img: torch.Tensor,
+    box_tensor: torch.Tensor,
+    crop_size: int = 224,
+    mode: str = 'bilinear',
+    align_corners: bool = True,
+):
+    """
+    Crops every box of `box_tensor` (num_crops x 4) from every image of `img`
+    and resizes them to `crop_size` with a single `grid_sample` call. The
+    result is crop-major: `(num_crops * batch_size) x C x crop_size x
+    crop_size`, the same layout as concatenating the crops of the batch.
+
+    NOTE: the sampling grids of all the crops are stacked along the height
+    so that the input batch is not repeated once per crop.
+    """
+    batch_size, num_channels = img.shape[:2]
+    num_crops = box_tensor.shape[0]
+
+    theta = get_crop_theta(
+        box_tensor.to(device=img.device, dtype=img.dtype),
+        img.shape[2:],
+        align_corners=align_corners,
+    )
+    grid = F.affine_grid(
+        theta,
+        (num_crops, num_channels, crop_size, crop_size),
+        align_corners=align_corners,
+    )
+    grid = grid.view(1, num_crops * crop_size, crop_size, 2)
+    grid = grid.expand(batch_size, -1, -1, -1)
+
+    crops = F.grid_sample(
+        img,
+        grid,
+        mode=mode,
+        padding_mode='zeros',
+        align_corners=align_corners,
+    )
+    crops = crops.view(
+        batch_size,
+        num_channels,
+        num_crops,
+        crop_size,
+        crop_size,
+    ).permute(2, 0, 1, 3, 4)
+
+    return crops.reshape(-1, num_channels, crop_size, crop_size)
+
+
+def sample_offsets(
+    img_size: int,
+    size_tensor: torch.Tensor,
+):
+    """
+    Integer offsets uniformly distributed in `[0, img_size - size)`, like
+    `torch.randint(0, img_size - size, ())` for every size at once.
+    """
+    return (torch.rand(size_tensor.shape) *
+            (img_size - size_tensor)).floor()
+
+
+def get_stacked_random_crops(
+    img: torch.Tensor,
+    num_random_crops: int = 64,
+    min_crop_frac: float = .2,
+    max_crop_frac: float = .8,
+    crop_size: int = 224,
+):
+    """
+    Random crops whose height and width are independently drawn as a
+    fraction of the image size in `[min_crop_frac, max_crop_frac)`.
+    """
+    img_height, img_width = img.shape[2:]
+
+    crop_height = (img_height * torch.empty(num_random_crops).uniform_(
+        min_crop_frac,
+        max_crop_frac,
+    )).floor()
+    crop_width = (img_width * torch.empty(num_random_crops).uniform_(
+        min_crop_frac,
+        max_crop_frac,
+    )).floor()
+
+    box_tensor = torch.stack(
+        [
+            sample_offsets(img_height, crop_height),
+            sample_offsets(img_width, crop_width),
+            crop_height,
+            crop_width,
+        ],
+        -1,
+    )
+
+    return crop_and_resize(img, box_tensor, crop_size=crop_size)
@@ -12,6 +12,10 @@ import clip
 import PIL
 from dall_e import map_pixels, unmap_pixels, load_model
 
+from models.clip_utils import load_clip, encode_text
+from models.cutouts import get_stacked_random_crops
+from models.convergence import ConvergenceMonitor
+
 target_img_size = 256
 embed_size = target_img_size // 8
 dalle_latent_dim = 8192
@@ -19,8 +23,7 @@ dalle_latent_dim = 8192
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
 print("USING ", DEVICE)
 
-clip_model, clip_preprocess = clip.load("ViT-B/32", device=DEVICE)
-clip_model.eval()
+clip_model, clip_preprocess = load_clip("ViT-B/32", device=DEVICE)
 # NOTE: just adding the normalization transformation
 clip_transform = T.Compose([
     clip_preprocess.transforms[4],
@@ -72,40 +75,14 @@ def get_clip_img_encodings(
     return img_logits
 
 
-def compute_clip_loss(img, text):
+def compute_clip_loss(img, text_logits):
     img_logits = get_clip_img_encodings(img)
 
-    tokenized_text = clip.tokenize([text]).to(DEVICE).detach().clone()
-    text_logits = clip_model.encode_text(tokenized_text)
-
     loss = -torch.cosine_similarity(text_logits, img_logits).mean()
 
     return loss
 
 
-def get_stacked_random_crops(img, num_random_crops=64):
-    img_size = [img.shape[2], img.shape[3]]
-
-    crop_list = []
-    for _ in range(num_random_crops):
-        crop_size_y = int(img_size[0] * torch.zeros(1, ).uniform_(.75, .95))
-        crop_size_x = int(img_size[1] * torch.zeros(1, ).uniform_(.75, .95))
-
-        y_offset = torch.randint(0, img_size[0] - crop_size_y, ())
-        x_offset = torch.randint(0, img_size[1] - crop_size_x, ())
-
-        crop = img[:, :, y_offset:y_offset + crop_size_y,
-                   x_offset:x_offset + crop_size_x]
-
-        crop = F.upsample_bilinear(crop, (224, 224))
-
-        crop_list.append(crop)
-
-    img = torch.cat(crop_list, axis=0)
-
-    return img
-
-
 def generate_from_prompt(
     prompt: str,
     lr: float = 3e-1,
@@ -113,8 +90,11 @@ def generate_from_prompt(
     num_generations: int = 200,
     num_random_crops: int = 20,
     img_batch=None,
+    early_stopping: bool = True,
 ):
     gen_img_list = []
+    convergence_monitor = ConvergenceMonitor(
+        stop_on_convergence=early_stopping)
 
     # z_logits = .5 * torch.randn(1, dalle_latent_dim, embed_size,
     #                             embed_size).cuda()
@@ -146,9 +126,13 @@ def generate_from_prompt(
         weight_decay=0.1,
     )
 
+    text_logits = encode_text(prompt, model_name="ViT-B/32", device=DEVICE)
+
     temp = 1
     for step in range(num_generations):
-        loss = 0
+        # NOTE: without a conditioning image no loss term is active, the loss
+        # stays a constant zero
+        loss = torch.zeros((), device=DEVICE)
 
         print(z_logits.max())
 
@@ -167,9 +151,11 @@ def generate_from_prompt(
         x_rec_stacked = get_stacked_random_crops(
             img=x_rec,
             num_random_crops=num_random_crops,
+            min_crop_frac=.75,
+            max_crop_frac=.95,
         )
 
-        # loss += 10 * compute_clip_loss(x_rec_stacked, prompt)
+        # loss += 10 * compute_clip_loss(x_rec_stacked, text_logits)
 
         # if img_batch is not None:
         #     loss += -torch.cosine_similarity(z_logits,
@@ -180,9 +166,10 @@ def generate_from_prompt(
 
         print(loss)
 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        if loss.requires_grad:
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
 
         if step % img_save_freq == 0:
             print("Saving generation...")
@@ -191,6 +178,11 @@ def generate_from_prompt(
 
             x_rec_img.save(f"test_imgs/{step}.png")
 
+        # NOTE: a constant loss would be reported as converged
+        if img_batch is not None and convergence_monitor.update(float(loss)):
+            print(f"Converged after {step + 1} steps")
+            break
+
     return gen_img_list
 
 
@@ -0,0 +1,83 @@
+import math
+from typing import *
+
+import numpy as np
+import torch
+from PIL import Image
+
+# NOTE: `inference_mode` is only available from torch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def get_interp_weights(num_steps: int, ):
+    """
+    Ease in-out blending weights of the frames of a segment.
+    """
+    return torch.tensor([
+        math.sin(1.5708 * step / num_steps)**2 for step in range(num_steps)
+    ])
+
+
+def imgs_to_pil_list(img):
+    """
+    Converts a `num_frames x batch_size x 3 x H x W` tensor in [0, 1] into
+    PIL frames with the samples of the batch side by side.
+    """
+    img = (img.clamp(0, 1) * 255).to(torch.uint8).cpu().numpy()
+    img = np.transpose(img, (0, 3, 1, 4, 2))
+    img = img.reshape(*img.shape[:2], -1, img.shape[-1])
+
+    return [Image.fromarray(frame_img) for frame_img in img]
+
+
+def render_interpolation(
+    feat_list: List[torch.Tensor],
+    duration_list: List[float],
+    decode: Callable,
+    fps: int = 25,
+    chunk_size: int = 8,
+    frame_sink_list: List = None,
+    keep_all_frames: bool = True,
+    should_stop: Callable = None,
+):
+    """
+    Renders the loop going through `feat_list`, spending `duration_list[i]`
+    seconds between features `i` and `i + 1`. `decode` maps a batch of
+    features to images in [0, 1]. Frames are decoded `chunk_size` at a time
+    without autograd and handed to `frame_sink_list` as soon as they are
+    ready, the blended features of a chunk are only built when it is decoded.
+    Rendering ends early once `should_stop` returns True, it is checked
+    before every chunk.
+    """
+    if frame_sink_list is None:
+        frame_sink_list = []
+
+    gen_img_list = []
+    with inference_mode():
+        for idx, (feat, duration) in enumerate(zip(feat_list, duration_list)):
+            num_steps = int(duration * fps)
+            feat_1 = feat
+            feat_2 = feat_list[(idx + 1) % len(feat_list)]
+            batch_size = feat_1.shape[0]
+
+            weights = get_interp_weights(num_steps).to(
+                device=feat_1.device,
+                dtype=feat_1.dtype,
+            )
+            for weight_chunk in weights.split(chunk_size):
+                if should_stop is not None and should_stop():
+                    return gen_img_list
+
+                weight_chunk = weight_chunk.view(-1, *[1] * feat_1.dim())
+                feat_chunk = weight_chunk * feat_2 + (1 - weight_chunk) * feat_1
+
+                img = decode(feat_chunk.flatten(0, 1))
+                img = img.view(-1, batch_size, *img.shape[1:])
+
+                for pil_img in imgs_to_pil_list(img):
+                    if keep_all_frames:
+                        gen_img_list.append(pil_img)
+                    for frame_sink in frame_sink_list:
+                        frame_sink.add_frame(pil_img)
+
+    return gen_img_list
@@ -0,0 +1,132 @@
+from typing import *
+
+import torch
+
+
+class GenerationSession:
+    """
+    Optimization state of a single generation job. Generators create it with
+    `init_session` and advance any number of compatible sessions at once with
+    `batched_step`, which stacks their latents into a single batch. Every
+    session keeps its own latents and optimizer, so sessions can join and
+    leave a running batch between steps.
+    """
+    def __init__(
+        self,
+        prompt: str,
+        latents,
+        optimizer,
+        text_logits,
+        num_steps: int,
+        img_save_freq: int = 1,
+    ):
+        self.prompt = prompt
+        self.latents = latents
+        self.optimizer = optimizer
+        self.text_logits = text_logits
+        self.num_steps = num_steps
+        self.img_save_freq = img_save_freq
+
+        self.step = 0
+        self.loss = None
+
+        # NOTE: set between steps to end the session early, a stopped session
+        # keeps its frames while a cancelled one is discarded
+        self.stopped = False
+        self.cancelled = False
+        # NOTE: set by `convergence.ConvergenceMonitor`, a converged session
+        # is complete even though it ran fewer than `num_steps` steps
+        self.converged = False
+
+        self.gen_img_list = []
+        self.feat_list = []
+        # NOTE: when frames are streamed to a video sink only the latest frame
+        # and features need to stay in memory
+        self.keep_all_frames = True
+
+        # NOTE: generator specific state (FFT scale, image size...)
+        self.extra = {}
+
+        # NOTE: called with the session after each of its steps
+        self.callback_list = []
+        # NOTE: receive every frame as soon as it is produced
+        self.frame_sink_list = []
+
+        # NOTE: RNG state of the session (see `get_rng_state`), when set its
+        # steps draw their random crops and noise from it instead of the
+        # global RNG of the process
+        self.rng_state = None
+
+    def add_frame(self, img):
+        if self.keep_all_frames:
+            self.gen_img_list.append(img)
+        else:
+            self.gen_img_list = [img]
+
+        for frame_sink in self.frame_sink_list:
+            frame_sink.add_frame(img)
+
+    def add_feat(self, feat):
+        if self.keep_all_frames:
+            self.feat_list.append(feat)
+        else:
+            self.feat_list = [feat]
+
+    def close_frame_sinks(self, ):
+        for frame_sink in self.frame_sink_list:
+            frame_sink.close()
+
+    @property
+    def finished(self, ):
+        if self.stopped or self.cancelled or self.converged:
+            return True
+
+        return self.step >= self.num_steps
+
+
+def get_rng_state():
+    cuda_rng_state_list = []
+    if torch.cuda.is_available():
+        cuda_rng_state_list = torch.cuda.get_rng_state_all()
+
+    return torch.get_rng_state(), cuda_rng_state_list
+
+
+def set_rng_state(rng_state, ):
+    cpu_rng_state, cuda_rng_state_list = rng_state
+    torch.set_rng_state(cpu_rng_state)
+    if len(cuda_rng_state_list) > 0:
+        torch.cuda.set_rng_state_all(cuda_rng_state_list)
+
+
+def step_sessions(
+    batched_step: Callable,
+    session_list: List[GenerationSession],
+):
+    """
+    Runs a step of `session_list`. The step draws from the RNG state of the
+    first session, so sessions sharing a batch share its random crops, and
+    the global RNG is restored afterwards.
+    """
+    lead_session = session_list[0]
+    if lead_session.rng_state is None:
+        batched_step(session_list)
+    else:
+        with torch.random.fork_rng():
+            set_rng_state(lead_session.rng_state)
+            batched_step(session_list)
+            lead_session.rng_state = get_rng_state()
+
+    for session in session_list:
+        for callback in session.callback_list:
+            callback(session)
+
+
+def run_session(
+    batched_step: Callable,
+    session: GenerationSession,
+):
+    while not session.finished:
+        step_sessions(batched_step, [session])
+
+    return session.gen_img_list, session.feat_list
@@ -1,6 +1,7 @@
 import os
 import math
 import argparse
+from typing import *
 
 import torch
 import torchvision
@@ -8,7 +9,11 @@ import clip
 import numpy as np
 from PIL import Image
 
-from models.stylegan_models import g_synthesis
+from models.stylegan_models import get_g_synthesis, get_g_mapping
+from models.checkpoints import save_state_dict_file
+from models.clip_utils import load_clip, warmup_clip, encode_text
+from models.session import GenerationSession, run_session
+from models.interpolation import render_interpolation
 
 torch.manual_seed(20)
 
@@ -55,8 +60,20 @@ def tensor_to_pil_img(img):
 
 
 class StyleGAN:
-    def __init__(self, ):
-        args = parser.parse_args()
+    def __init__(
+        self,
+        loss_resolution: int = None,
+        activation_checkpointing: bool = False,
+        activation_memory_budget_mb: float = None,
+    ):
+        """
+        With `loss_resolution` below 1024 the CLIP loss is computed on the
+        output of the synthesis block of that resolution, through a fitted
+        to-RGB layer, and the remaining blocks only run for the saved frames.
+        With `activation_checkpointing` the synthesis blocks are recomputed in
+        the backward pass, see `G_synthesis.set_activation_checkpointing`.
+        """
+        args, _unknown_args = parser.parse_known_args()
 
         output_path = args.output_path
         self.batch_size = args.batch_size
@@ -71,12 +88,21 @@ class StyleGAN:
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
-        self.clip_model, self.clip_preprocess = clip.load(
+        self.clip_model, self.clip_preprocess = load_clip(
             "ViT-B/32",
             device=self.device,
         )
-        g_synthesis.eval()
-        g_synthesis.to(self.device)
+        # NOTE: the mapping network is not needed, the latents are optimized
+        # directly in the disentangled space
+        self.g_synthesis = get_g_synthesis()
+        self.g_synthesis.to(self.device)
+        # NOTE: only the latents are optimized, so the weights can be shared
+        # between jobs without accumulating gradients
+        self.g_synthesis.requires_grad_(False)
+        self.g_synthesis.set_activation_checkpointing(
+            activation_checkpointing,
+            memory_budget_mb=activation_memory_budget_mb,
+        )
 
         self.latent_shape = (self.batch_size, 1, 512)
 
@@ -95,6 +121,87 @@ class StyleGAN:
             std=(0.26862954, 0.26130258, 0.27577711),
         )
 
+        self.loss_num_blocks = None
+        if loss_resolution is not None and loss_resolution < 1024:
+            # NOTE: block `i` outputs features of size `2**(i + 2)`
+            self.loss_num_blocks = int(np.log2(loss_resolution)) - 1
+            self.torgb_weight, self.torgb_bias = self.load_intermediate_torgb(
+                loss_resolution)
+
+    def load_intermediate_torgb(
+        self,
+        resolution: int,
+    ):
+        torgb_path = f"./server/models/sg1_torgb_{resolution}.pt"
+        if os.path.exists(torgb_path):
+            torgb_dict = torch.load(torgb_path, map_location=self.device)
+        else:
+            torgb_dict = self.fit_intermediate_torgb(self.loss_num_blocks)
+            # NOTE: several workers may fit it at the same time
+            save_state_dict_file(torgb_dict, torgb_path)
+
+        return torgb_dict['weight'], torgb_dict['bias']
+
+    def fit_intermediate_torgb(
+        self,
+        num_blocks: int,
+        num_samples: int = 16,
+        batch_size: int = 2,
+    ):
+        """
+        The checkpoint only has the to-RGB layer of the last block, so the one
+        for the output of `num_blocks` blocks is fitted by least squares to the
+        downscaled full resolution images of random latents.
+        """
+        print(f"Fitting the to-RGB layer of block {num_blocks - 1}...")
+
+        feat_size = 2**(num_blocks + 1)
+        feat_gram = 0
+        feat_img_prod = 0
+        g_mapping = get_g_mapping()
+        with torch.no_grad():
+            for _ in range(num_samples // batch_size):
+                dlatents = g_mapping(torch.randn(batch_size, 512)).to(
+                    self.device)
+                x = self.g_synthesis.run_blocks(dlatents, end_idx=num_blocks)
+                img = self.g_synthesis.torgb(
+                    self.g_synthesis.run_blocks(
+                        dlatents,
+                        x=x,
+                        start_idx=num_blocks,
+                    ))
+                img = torch.nn.functional.adaptive_avg_pool2d(img, feat_size)
+
+                feats = x.permute(0, 2, 3, 1).reshape(-1, x.shape[1]).double()
+                feats = torch.cat([feats, torch.ones_like(feats[:, :1])], 1)
+                img = img.permute(0, 2, 3, 1).reshape(-1, 3).double()
+
+                feat_gram = feat_gram + feats.T @ feats
+                feat_img_prod = feat_img_prod + feats.T @ img
+
+            solution = (torch.pinverse(feat_gram) @ feat_img_prod).float()
+
+        torgb_dict = {
+            'weight': solution[:-1].T[:, :, None, None].contiguous(),
+            'bias': solution[-1].contiguous(),
+        }
+
+        return torgb_dict
+
+    def shared_modules(self, ):
+        """
+        Modules holding the weights of the model, see
+        `model_utils.share_model_memory`.
+        """
+        return [self.clip_model, self.g_synthesis]
+
+    def warmup(self, ):
+        warmup_clip(self.clip_model, device=self.device)
+
+        with torch.no_grad():
+            dlatents = torch.zeros(self.latent_shape).to(self.device)
+            self.g_synthesis(dlatents.repeat(1, 18, 1))
+
     def truncation(
         self,
         x,
@@ -108,19 +215,20 @@ class StyleGAN:
             self.device)
         return torch.where(do_trunc, interp, x)
 
+    def get_clip_text_encodings(self, text):
+        return encode_text(text, model_name="ViT-B/32", device=self.device)
+
     def compute_clip_loss(
         self,
         img,
-        text,
+        text_logits,
     ):
         img = ((img + 1) /2).clip(0,1)
         # img = self.clip_transform(img)
         img = self.clip_normalize(img)
         img = torch.nn.functional.upsample_bilinear(img, (224, 224))
-        tokenized_text = clip.tokenize([text]).to(self.device)
 
         img_logits = self.clip_model.encode_image(img)
-        text_logits = self.clip_model.encode_text(tokenized_text)
 
         # img_logits, _text_logits = self.clip_model(img, tokenized_text)
 
@@ -128,7 +236,7 @@ class StyleGAN:
 
         return -10 * loss
 
-    def generate_from_prompt(
+    def init_session(
         self,
         prompt: str,
         lr: float = 1e-2,
@@ -146,62 +254,152 @@ class StyleGAN:
             betas=(0.9, 0.999),
         )
 
-        gen_img_list = []
-        latents_list = []
-        counter = 0
-        for _step in range(num_generations):
-            dlatents = latents.repeat(1, 18, 1)
-            img = g_synthesis(dlatents)
+        session = GenerationSession(
+            prompt=prompt,
+            latents=latents,
+            optimizer=optimizer,
+            text_logits=self.get_clip_text_encodings(prompt),
+            num_steps=num_generations,
+            img_save_freq=img_save_freq,
+        )
 
-            # NOTE: clip normalization did not seem to have much effect
-            # img = self.clip_normalize(img)
+        return session
 
-            loss = self.compute_clip_loss(img, prompt)
+    def warm_start_session(
+        self,
+        session: GenerationSession,
+        latents,
+        noise_frac: float = 0.,
+    ):
+        """
+        Starts `session` from the final latents of a previous session, blended
+        with a `noise_frac` fraction of gaussian noise, as sessions otherwise
+        start from zero latents.
+        """
+        with torch.no_grad():
+            session.latents.copy_((1 - noise_frac) *
+                                  latents.to(session.latents.device) +
+                                  noise_frac *
+                                  torch.randn_like(session.latents))
+
+    def batched_step(
+        self,
+        session_list: List[GenerationSession],
+    ):
+        latents = torch.cat([session.latents for session in session_list])
+        text_logits = torch.cat([
+            session.text_logits.expand(session.latents.shape[0], -1)
+            for session in session_list
+        ])
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+        dlatents = latents.repeat(1, 18, 1)
+        if self.loss_num_blocks is None:
+            img = self.g_synthesis(dlatents)
+            loss_img = img
+        else:
+            x = self.g_synthesis.run_blocks(
+                dlatents,
+                end_idx=self.loss_num_blocks,
+            )
+            loss_img = torch.nn.functional.conv2d(
+                x,
+                self.torgb_weight,
+                self.torgb_bias,
+            )
+
+        # NOTE: clip normalization did not seem to have much effect
+        # img = self.clip_normalize(img)
+
+        sample_loss = self.compute_clip_loss(loss_img, text_logits)
+
+        split_size_list = [session.latents.shape[0] for session in session_list]
+        session_loss_list = [
+            session_sample_loss.mean()
+            for session_sample_loss in sample_loss.split(split_size_list)
+        ]
+
+        for session in session_list:
+            session.optimizer.zero_grad()
+
+        torch.stack(session_loss_list).sum().backward()
+
+        if self.loss_num_blocks is not None:
+            # NOTE: the last blocks only run when a frame is saved, for the
+            # whole batch
+            if any((session.step + 1) % session.img_save_freq == 0
+                   for session in session_list):
+                with torch.no_grad():
+                    img = self.g_synthesis.torgb(
+                        self.g_synthesis.run_blocks(
+                            dlatents.detach(),
+                            x=x.detach(),
+                            start_idx=self.loss_num_blocks,
+                        ))
+            else:
+                img = loss_img
+
+        img_list = img.detach().split(split_size_list)
+        for session, session_loss, session_img in zip(
+                session_list, session_loss_list, img_list):
+            session.optimizer.step()
+            session.loss = session_loss.item()
+            session.step += 1
+
+            if session.step % session.img_save_freq == 0:
+                session.add_frame(tensor_to_pil_img(session_img))
+
+                print(f'Step {session.step}')
+                print(f'Loss {session.loss}')
+
+                session.add_feat(session.latents.detach().clone())
 
-            counter += 1
+    def generate_from_prompt(
+        self,
+        prompt: str,
+        lr: float = 1e-2,
+        img_save_freq: int = 1,
+        num_generations: int = 200,
+        callback_list: List[Callable] = None,
+        frame_sink_list: List = None,
+        keep_all_frames: bool = True,
+    ):
+        session = self.init_session(
+            prompt=prompt,
+            lr=lr,
+            img_save_freq=img_save_freq,
+            num_generations=num_generations,
+        )
 
-            if counter % img_save_freq == 0:
-                img = tensor_to_pil_img(img)
-                img.save(f"generations/{counter}.png")
-                gen_img_list.append(img)
+        if callback_list is not None:
+            session.callback_list = callback_list
+        if frame_sink_list is not None:
+            session.frame_sink_list = frame_sink_list
+        session.keep_all_frames = keep_all_frames
 
-                print(f'Step {counter}')
-                print(f'Loss {loss.data.cpu().numpy()[0]}')
+        return run_session(self.batched_step, session)
 
-                latents_list.append(latents.clone())
+    def decode(self, latents):
+        img = self.g_synthesis(latents.repeat(1, 18, 1))
+        img = (img.clamp(-1, 1) + 1) / 2.0
 
-        return gen_img_list, latents_list
+        return img
 
     def interpolate(
+        self,
         latents_list,
         duration_list,
+        frame_sink_list: List = None,
+        keep_all_frames: bool = True,
+        should_stop: Callable = None,
     ):
-        gen_img_list = []
-        fps = 25
-
-        for idx, (latents,
-                  duration) in enumerate(zip(latents_list, duration_list)):
-            num_steps = int(duration * fps)
-            latents1 = latents
-            latents2 = latents_list[(idx + 1) % len(latents_list)]
-
-            dlatents1 = latents1.repeat(1, 18, 1)
-            dlatents2 = latents2.repeat(1, 18, 1)
-
-            for step in range(num_steps):
-                weight = math.sin(1.5708 * step / num_steps)**2
-                dlatents = weight * dlatents2 + (1 - weight) * dlatents1
-
-                img = g_synthesis(dlatents)
-                img = tensor_to_pil_img(img)
-
-                gen_img_list.append(img)
-
-        return gen_img_list
+        return render_interpolation(
+            latents_list,
+            duration_list,
+            decode=self.decode,
+            frame_sink_list=frame_sink_list,
+            keep_all_frames=keep_all_frames,
+            should_stop=should_stop,
+        )
 
 
 if __name__ == "__main__":
@@ -7,10 +7,19 @@ import torch.nn.functional as F
 import numpy as np
 from collections import OrderedDict
 
-if not os.path.exists('./server/models/sg1.pt'):
-    os.system(
-        "wget 'https://github.com/lernapparat/lernapparat/releases/download/v2019-02-01/karras2019stylegan-ffhq-1024x1024.for_g_all.pt' -O './server/models/sg1.pt'"
-    )
+from models.activation_checkpointing import (
+    checkpoint_segment,
+    needs_recompute,
+    get_checkpoint_mask,
+)
+from models.checkpoints import (
+    save_state_dict_file,
+    load_state_dict_file,
+    load_weights,
+)
+
+SG1_CKPT_URL = "https://github.com/lernapparat/lernapparat/releases/download/v2019-02-01/karras2019stylegan-ffhq-1024x1024.for_g_all.pt"
+SG1_CKPT_PATH = './server/models/sg1.pt'
 
 
 class MyLinear(nn.Module):
@@ -289,7 +298,8 @@ class G_mapping(nn.Sequential):
     def forward(self, x):
         x = super().forward(x)
         # Broadcast
-        x = x.expand(-1, 18, -1)
+        # NOTE: `x` is `B x 512`, one latent per synthesis layer
+        x = x.unsqueeze(1).expand(-1, 18, -1)
         return x
 
 
@@ -455,9 +465,13 @@ class G_synthesis(nn.Module):
         num_styles = num_layers if use_styles else 1
         torgbs = []
         blocks = []
+        # NOTE: rough number of activation values each block stores per sample
+        # for the backward pass, used to honour a memory budget
+        self.block_size_list = []
         for res in range(2, resolution_log2 + 1):
             channels = nf(res - 1)
             name = '{s}x{s}'.format(s=2**res)
+            self.block_size_list.append(10 * channels * 4**res)
             if res == 2:
                 blocks.append(
                     (name,
@@ -479,29 +493,133 @@ class G_synthesis(nn.Module):
                               gain=1,
                               use_wscale=use_wscale)
         self.blocks = nn.ModuleDict(OrderedDict(blocks))
+        self.checkpoint_mask = [False] * len(blocks)
+
+    def set_activation_checkpointing(self, enabled=True, memory_budget_mb=None):
+        """
+        Recomputes the blocks in the backward pass instead of storing their
+        activations. With `memory_budget_mb` only the largest blocks are
+        recomputed, until the stored activations of a sample fit in it.
+        """
+        if not enabled:
+            self.checkpoint_mask = [False] * len(self.blocks)
+            return
+
+        self.checkpoint_mask = get_checkpoint_mask(
+            self.block_size_list,
+            memory_budget_mb,
+        )
+
+    def run_blocks(self, dlatents_in, x=None, start_idx=0, end_idx=None):
+        """
+        Runs the synthesis blocks `start_idx` to `end_idx` (excluded), `x` being
+        the output of block `start_idx - 1`. Block `i` outputs features of size
+        `2**(i + 2)`.
+        """
+        block_list = list(self.blocks.values())[start_idx:end_idx]
+        for i, m in enumerate(block_list, start_idx):
+            block_args = (dlatents_in[:, 2 * i:2 * i + 2], )
+            if i != 0:
+                block_args = (x, ) + block_args
+
+            if self.checkpoint_mask[i] and needs_recompute(*block_args):
+                x = checkpoint_segment(m, *block_args)
+            else:
+                x = m(*block_args)
+        return x
 
     def forward(self, dlatents_in):
         # Input: Disentangled latents (W) [minibatch, num_layers, dlatent_size].
         # lod_in = tf.cast(tf.get_variable('lod', initializer=np.float32(0), trainable=False), dtype)
-        batch_size = dlatents_in.size(0)
-        for i, m in enumerate(self.blocks.values()):
-            if i == 0:
-                x = m(dlatents_in[:, 2 * i:2 * i + 2])
-            else:
-                x = m(x, dlatents_in[:, 2 * i:2 * i + 2])
+        x = self.run_blocks(dlatents_in)
         rgb = self.torgb(x)
         return rgb
 
 
 avg_latent = torch.zeros(1, 18, 512)
 
-g_all = nn.Sequential(
-    OrderedDict([
-        ('g_mapping', G_mapping()),
-        # ('truncation', Truncation(avg_latent)),
-        ('g_synthesis', G_synthesis())
-    ]))
-g_all.load_state_dict(torch.load('./server/models/sg1.pt'))
+# NOTE: submodules of the `g_all` checkpoint, each one is split into its own
+# file so that a job only reads the weights it uses
+SUBMODULE_CLASS_DICT = OrderedDict([
+    ('g_mapping', G_mapping),
+    ('g_synthesis', G_synthesis),
+])
+
+# NOTE: filled on first use, shared by every job of the process
+_submodule_dict = {}
+
+
+def get_submodule_ckpt_path(submodule_name: str, ) -> str:
+    return f"./server/models/sg1_{submodule_name}.pt"
+
+
+def download_checkpoint():
+    if not os.path.exists(SG1_CKPT_PATH):
+        os.system(f"wget '{SG1_CKPT_URL}' -O '{SG1_CKPT_PATH}'")
+
+
+def split_checkpoint():
+    """
+    Writes the weights of every submodule of the `g_all` checkpoint into a
+    separate file, downloading the checkpoint first if needed.
+    """
+    download_checkpoint()
+
+    print(f"Splitting {SG1_CKPT_PATH}...")
+    state_dict = torch.load(SG1_CKPT_PATH, map_location="cpu")
+    for submodule_name in SUBMODULE_CLASS_DICT:
+        prefix = f"{submodule_name}."
+        submodule_state_dict = {
+            key[len(prefix):]: value
+            for key, value in state_dict.items() if key.startswith(prefix)
+        }
+
+        save_state_dict_file(
+            submodule_state_dict,
+            get_submodule_ckpt_path(submodule_name),
+        )
+
+
+def load_submodule(submodule_name: str, ):
+    """
+    Builds only `submodule_name` and loads its weights from its memory mapped
+    file. Loaded submodules are kept for the rest of the process.
+    """
+    if submodule_name in _submodule_dict:
+        return _submodule_dict[submodule_name]
+
+    submodule_ckpt_path = get_submodule_ckpt_path(submodule_name)
+    if not os.path.exists(submodule_ckpt_path):
+        split_checkpoint()
+
+    submodule = SUBMODULE_CLASS_DICT[submodule_name]()
+    load_weights(submodule, load_state_dict_file(submodule_ckpt_path))
+    submodule.eval()
+
+    _submodule_dict[submodule_name] = submodule
+
+    return submodule
+
+
+def get_g_mapping():
+    return load_submodule('g_mapping')
+
+
+def get_g_synthesis():
+    return load_submodule('g_synthesis')
+
+
+def __getattr__(name: str):
+    """
+    Keeps `from models.stylegan_models import g_synthesis` working, loading
+    the weights when the name is first imported instead of at import time.
+    """
+    if name in SUBMODULE_CLASS_DICT:
+        return load_submodule(name)
+
+    if name == 'g_all':
+        return nn.Sequential(
+            OrderedDict([(submodule_name, load_submodule(submodule_name))
+                         for submodule_name in SUBMODULE_CLASS_DICT]))
 
-g_synthesis = g_all.g_synthesis
-g_mapping = g_all.g_mapping
\ No newline at end of file
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,9 +1,16 @@
 # pytorch_diffusion + derived encoder decoder
 import math
+import functools
 import torch
 import torch.nn as nn
 import numpy as np
 
+from models.activation_checkpointing import (
+    checkpoint_segment,
+    needs_recompute,
+    get_checkpoint_mask,
+)
+
 
 def get_timestep_embedding(timesteps, embedding_dim):
     """
@@ -137,10 +144,38 @@ class ResnetBlock(nn.Module):
         return x+h
 
 
+# NOTE: the fallback of "sdpa" attention is reported once per process, not
+# once per block
+_sdpa_fallback_logged = False
+
+
 class AttnBlock(nn.Module):
-    def __init__(self, in_channels):
+    """
+    Single head self-attention over the spatial positions. `attn_type` picks
+    the implementation, all of them compute the same function:
+    - "vanilla": materializes the full hw x hw attention matrix.
+    - "chunked": processes `chunk_size` queries at a time and recomputes each
+      chunk in backward, so memory grows linearly with hw. When all the
+      queries fit in a single chunk nothing is recomputed.
+    - "sdpa": fused `scaled_dot_product_attention` (torch >= 2.0), falls
+      back to "chunked" on older versions.
+    """
+    def __init__(self, in_channels, attn_type="vanilla", chunk_size=1024):
         super().__init__()
         self.in_channels = in_channels
+        self.attn_type = attn_type
+        self.chunk_size = chunk_size
+
+        if attn_type not in ("vanilla", "chunked", "sdpa"):
+            raise ValueError(f"ATTENTION TYPE {attn_type} NOT RECOGNIZED")
+        if attn_type == "sdpa" and not hasattr(
+                torch.nn.functional, "scaled_dot_product_attention"):
+            global _sdpa_fallback_logged
+            if not _sdpa_fallback_logged:
+                print(f"scaled_dot_product_attention not available in torch "
+                      f"{torch.__version__}, using chunked attention")
+                _sdpa_fallback_logged = True
+            self.attn_type = "chunked"
 
         self.norm = Normalize(in_channels)
         self.q = torch.nn.Conv2d(in_channels,
@@ -164,6 +199,13 @@ class AttnBlock(nn.Module):
                                         stride=1,
                                         padding=0)
 
+    @staticmethod
+    def attend(q, k, v):
+        # q: b,n,c k: b,c,hw v: b,c,hw -> b,n,c
+        w_ = torch.bmm(q,k)
+        w_ = w_ * (int(q.shape[-1])**(-0.5))
+        w_ = torch.nn.functional.softmax(w_, dim=2)
+        return torch.bmm(w_, v.permute(0,2,1))
 
     def forward(self, x):
         h_ = x
@@ -174,18 +216,44 @@ class AttnBlock(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
-        q = q.reshape(b,c,h*w)
-        q = q.permute(0,2,1)   # b,hw,c
-        k = k.reshape(b,c,h*w) # b,c,hw
-        w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
-        w_ = w_ * (int(c)**(-0.5))
-        w_ = torch.nn.functional.softmax(w_, dim=2)
+        if self.attn_type == "sdpa":
+            q = q.reshape(b,c,h*w).permute(0,2,1) # b,hw,c
+            k = k.reshape(b,c,h*w).permute(0,2,1) # b,hw,c
+            v = v.reshape(b,c,h*w).permute(0,2,1) # b,hw,c
+            h_ = torch.nn.functional.scaled_dot_product_attention(q,k,v)
+            h_ = h_.permute(0,2,1).reshape(b,c,h,w)
+
+        elif self.attn_type == "chunked":
+            q = q.reshape(b,c,h*w).permute(0,2,1) # b,hw,c
+            k = k.reshape(b,c,h*w)                # b,c,hw
+            v = v.reshape(b,c,h*w)                # b,c,hw
+            # NOTE: a single chunk stores the same activations as vanilla
+            # attention, recomputing it would not save any memory
+            recompute = h*w > self.chunk_size and needs_recompute(q, k, v)
+
+            h_list = []
+            for q_chunk in q.split(self.chunk_size, dim=1):
+                if recompute:
+                    h_list.append(checkpoint_segment(
+                        self.attend, q_chunk, k, v))
+                else:
+                    h_list.append(self.attend(q_chunk, k, v))
+            h_ = torch.cat(h_list, dim=1)         # b,hw,c
+            h_ = h_.permute(0,2,1).reshape(b,c,h,w)
 
-        # attend to values
-        v = v.reshape(b,c,h*w)
-        w_ = w_.permute(0,2,1)   # b,hw,hw (first hw of k, second of q)
-        h_ = torch.bmm(v,w_)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
-        h_ = h_.reshape(b,c,h,w)
+        else:
+            q = q.reshape(b,c,h*w)
+            q = q.permute(0,2,1)   # b,hw,c
+            k = k.reshape(b,c,h*w) # b,c,hw
+            w_ = torch.bmm(q,k)     # b,hw,hw    w[b,i,j]=sum_c q[b,i,c]k[b,c,j]
+            w_ = w_ * (int(c)**(-0.5))
+            w_ = torch.nn.functional.softmax(w_, dim=2)
+
+            # attend to values
+            v = v.reshape(b,c,h*w)
+            w_ = w_.permute(0,2,1)   # b,hw,hw (first hw of k, second of q)
+            h_ = torch.bmm(v,w_)     # b, c,hw (hw of q) h_[b,c,j] = sum_i v[b,c,i] w_[b,i,j]
+            h_ = h_.reshape(b,c,h,w)
 
         h_ = self.proj_out(h_)
 
@@ -342,7 +410,8 @@ class Model(nn.Module):
 class Encoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
-                 resolution, z_channels, double_z=True, **ignore_kwargs):
+                 resolution, z_channels, double_z=True, attn_type="vanilla",
+                 **ignore_kwargs):
         super().__init__()
         self.ch = ch
         self.temb_ch = 0
@@ -373,7 +442,7 @@ class Encoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(AttnBlock(block_in))
+                    attn.append(AttnBlock(block_in, attn_type=attn_type))
             down = nn.Module()
             down.block = block
             down.attn = attn
@@ -388,7 +457,7 @@ class Encoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = AttnBlock(block_in)
+        self.mid.attn_1 = AttnBlock(block_in, attn_type=attn_type)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -436,7 +505,8 @@ class Encoder(nn.Module):
 class Decoder(nn.Module):
     def __init__(self, *, ch, out_ch, ch_mult=(1,2,4,8), num_res_blocks,
                  attn_resolutions, dropout=0.0, resamp_with_conv=True, in_channels,
-                 resolution, z_channels, give_pre_end=False, **ignorekwargs):
+                 resolution, z_channels, give_pre_end=False, attn_type="vanilla",
+                 **ignorekwargs):
         super().__init__()
         self.ch = ch
         self.temb_ch = 0
@@ -467,7 +537,7 @@ class Decoder(nn.Module):
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
                                        dropout=dropout)
-        self.mid.attn_1 = AttnBlock(block_in)
+        self.mid.attn_1 = AttnBlock(block_in, attn_type=attn_type)
         self.mid.block_2 = ResnetBlock(in_channels=block_in,
                                        out_channels=block_in,
                                        temb_channels=self.temb_ch,
@@ -475,6 +545,9 @@ class Decoder(nn.Module):
 
         # upsampling
         self.up = nn.ModuleList()
+        # NOTE: rough number of activation values each up level stores per
+        # sample for the backward pass, used to honour a memory budget
+        self.up_size_list = [0] * self.num_resolutions
         for i_level in reversed(range(self.num_resolutions)):
             block = nn.ModuleList()
             attn = nn.ModuleList()
@@ -486,15 +559,19 @@ class Decoder(nn.Module):
                                          dropout=dropout))
                 block_in = block_out
                 if curr_res in attn_resolutions:
-                    attn.append(AttnBlock(block_in))
+                    attn.append(AttnBlock(block_in, attn_type=attn_type))
             up = nn.Module()
             up.block = block
             up.attn = attn
+            self.up_size_list[i_level] = 6*(self.num_res_blocks+1)*block_out*curr_res**2
             if i_level != 0:
                 up.upsample = Upsample(block_in, resamp_with_conv)
                 curr_res = curr_res * 2
+                self.up_size_list[i_level] += 2*block_in*curr_res**2
             self.up.insert(0, up) # prepend to get consistent order
 
+        self.checkpoint_mask = [False] * self.num_resolutions
+
         # end
         self.norm_out = Normalize(block_in)
         self.conv_out = torch.nn.Conv2d(block_in,
@@ -503,6 +580,28 @@ class Decoder(nn.Module):
                                         stride=1,
                                         padding=1)
 
+    def set_activation_checkpointing(self, enabled=True, memory_budget_mb=None):
+        """
+        Recomputes the up levels in the backward pass instead of storing their
+        activations. With `memory_budget_mb` only the largest levels are
+        recomputed, until the stored activations of a sample fit in it.
+        """
+        if not enabled:
+            self.checkpoint_mask = [False] * self.num_resolutions
+            return
+
+        self.checkpoint_mask = get_checkpoint_mask(self.up_size_list,
+                                                   memory_budget_mb)
+
+    def run_up_level(self, i_level, h, temb=None):
+        for i_block in range(self.num_res_blocks+1):
+            h = self.up[i_level].block[i_block](h, temb)
+            if len(self.up[i_level].attn) > 0:
+                h = self.up[i_level].attn[i_block](h)
+        if i_level != 0:
+            h = self.up[i_level].upsample(h)
+        return h
+
     def forward(self, z):
         #assert z.shape[1:] == self.z_shape[1:]
         self.last_z_shape = z.shape
@@ -520,12 +619,13 @@ class Decoder(nn.Module):
 
         # upsampling
         for i_level in reversed(range(self.num_resolutions)):
-            for i_block in range(self.num_res_blocks+1):
-                h = self.up[i_level].block[i_block](h, temb)
-                if len(self.up[i_level].attn) > 0:
-                    h = self.up[i_level].attn[i_block](h)
-            if i_level != 0:
-                h = self.up[i_level].upsample(h)
+            if self.checkpoint_mask[i_level] and needs_recompute(h):
+                # NOTE: only tensors go through the checkpoint, the reentrant
+                # version of torch < 1.11 saves every argument for backward
+                h = checkpoint_segment(
+                    functools.partial(self.run_up_level, i_level), h)
+            else:
+                h = self.run_up_level(i_level, h, temb)
 
         # end
         if self.give_pre_end:
@@ -14,56 +14,57 @@ class VectorQuantizer(nn.Module):
     _____________________________________________
     """
 
-    def __init__(self, n_e, e_dim, beta):
+    def __init__(self, n_e, e_dim, beta, chunk_size=4096):
         super(VectorQuantizer, self).__init__()
         self.n_e = n_e
         self.e_dim = e_dim
         self.beta = beta
+        # NOTE: rows of z compared to the whole codebook at once
+        self.chunk_size = chunk_size
 
         self.embedding = nn.Embedding(self.n_e, self.e_dim)
         self.embedding.weight.data.uniform_(-1.0 / self.n_e, 1.0 / self.n_e)
 
+    def get_nearest_indices(self, z_flattened):
+        """
+        Index of the closest embedding of every row of `z_flattened`. The
+        distances are computed `chunk_size` rows at a time, so only a chunk x
+        n_e matrix is alive at once.
+        """
+        with torch.no_grad():
+            e_sq = torch.sum(self.embedding.weight**2, dim=1)
+
+            index_list = []
+            for z_chunk in z_flattened.split(self.chunk_size):
+                # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
+                d = torch.sum(z_chunk ** 2, dim=1, keepdim=True) + e_sq - 2 * \
+                    torch.matmul(z_chunk, self.embedding.weight.t())
+                index_list.append(torch.argmin(d, dim=1))
+
+        return torch.cat(index_list)
+
     def forward(self, z):
         """
-        Inputs the output of the encoder network z and maps it to a discrete
-        one-hot vector that is the index of the closest embedding vector e_j
+        Inputs the output of the encoder network z and maps it to the index of
+        the closest embedding vector e_j
         z (continuous) -> z_q (discrete)
         z.shape = (batch, channel, height, width)
         quantization pipeline:
             1. get encoder input (B,C,H,W)
             2. flatten input to (B*H*W,C)
+
+        NOTE: the one-hot encodings are never built, `min_encodings` is
+        returned as None
         """
         # reshape z -> (batch, height, width, channel) and flatten
         z = z.permute(0, 2, 3, 1).contiguous()
         z_flattened = z.view(-1, self.e_dim)
-        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
 
-        d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
-            torch.sum(self.embedding.weight**2, dim=1) - 2 * \
-            torch.matmul(z_flattened, self.embedding.weight.t())
-
-        ## could possible replace this here
-        # #\start...
         # find closest encodings
-        min_encoding_indices = torch.argmin(d, dim=1).unsqueeze(1)
-
-        min_encodings = torch.zeros(
-            min_encoding_indices.shape[0], self.n_e).to(z)
-        min_encodings.scatter_(1, min_encoding_indices, 1)
-
-        # dtype min encodings: torch.float32
-        # min_encodings shape: torch.Size([2048, 512])
-        # min_encoding_indices.shape: torch.Size([2048, 1])
+        min_encoding_indices = self.get_nearest_indices(z_flattened)
 
         # get quantized latent vectors
-        z_q = torch.matmul(min_encodings, self.embedding.weight).view(z.shape)
-        #.........\end
-
-        # with:
-        # .........\start
-        #min_encoding_indices = torch.argmin(d, dim=1)
-        #z_q = self.embedding(min_encoding_indices)
-        # ......\end......... (TODO)
+        z_q = self.embedding(min_encoding_indices).view(z.shape)
 
         # compute loss for embedding
         loss = torch.mean((z_q.detach()-z)**2) + self.beta * \
@@ -73,22 +74,19 @@ class VectorQuantizer(nn.Module):
         z_q = z + (z_q - z).detach()
 
         # perplexity
-        e_mean = torch.mean(min_encodings, dim=0)
+        e_mean = torch.bincount(
+            min_encoding_indices, minlength=self.n_e).to(z) / \
+            min_encoding_indices.shape[0]
         perplexity = torch.exp(-torch.sum(e_mean * torch.log(e_mean + 1e-10)))
 
         # reshape back to match original input shape
         z_q = z_q.permute(0, 3, 1, 2).contiguous()
 
-        return z_q, loss, (perplexity, min_encodings, min_encoding_indices)
+        return z_q, loss, (perplexity, None, min_encoding_indices.unsqueeze(1))
 
     def get_codebook_entry(self, indices, shape):
         # shape specifying (batch, height, width, channel)
-        # TODO: check for more easy handling with nn.Embedding
-        min_encodings = torch.zeros(indices.shape[0], self.n_e).to(indices)
-        min_encodings.scatter_(1, indices[:,None], 1)
-
-        # get quantized latent vectors
-        z_q = torch.matmul(min_encodings.float(), self.embedding.weight)
+        z_q = self.embedding(indices.reshape(-1))
 
         if shape is not None:
             z_q = z_q.view(shape)
@@ -97,3 +95,10 @@ class VectorQuantizer(nn.Module):
             z_q = z_q.permute(0, 3, 1, 2).contiguous()
 
         return z_q
+
+    def embed_code(self, code_b):
+        """
+        Quantized latents (batch, channel, height, width) of the code indices
+        `code_b` (batch, height, width).
+        """
+        return self.get_codebook_entry(code_b, (*code_b.shape, self.e_dim))
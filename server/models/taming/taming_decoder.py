@@ -13,36 +13,25 @@ import numpy as np
 import clip
 from omegaconf import OmegaConf
 
-# from cmodels.taming.vqgan import VQModel
-from models.taming.vqgan import VQModel
-
-
-# TODO: put this func into a utils file or something
-def get_stacked_random_crops(img, num_random_crops=64):
-    img_size = [img.shape[2], img.shape[3]]
-
-    crop_list = []
-    for _ in range(num_random_crops):
-        crop_size_y = int(img_size[0] * torch.zeros(1, ).uniform_(.75, .95))
-        crop_size_x = int(img_size[1] * torch.zeros(1, ).uniform_(.75, .95))
-
-        y_offset = torch.randint(0, img_size[0] - crop_size_y, ())
-        x_offset = torch.randint(0, img_size[1] - crop_size_x, ())
-
-        crop = img[:, :, y_offset:y_offset + crop_size_y,
-                   x_offset:x_offset + crop_size_x]
-
-        crop = F.upsample_bilinear(crop, (224, 224))
-
-        crop_list.append(crop)
-
-    img = torch.cat(crop_list, axis=0)
-
-    return img
+from models.taming.vqgan_inference import load_vq_inference_model
+from models.clip_utils import load_clip, warmup_clip, encode_text
+from models.session import GenerationSession, run_session
+from models.cutouts import crop_and_resize
+from models.interpolation import render_interpolation
 
 
 class TamingDecoder:
-    def __init__(self, ):
+    def __init__(
+        self,
+        attn_type: str = "sdpa",
+        activation_checkpointing: bool = False,
+        activation_memory_budget_mb: float = None,
+    ):
+        """
+        With `activation_checkpointing` the up levels of the decoder are
+        recomputed in the backward pass, see
+        `Decoder.set_activation_checkpointing`.
+        """
         if not os.path.exists('./server/models/taming/last.ckpt'):
             os.system(
                 " wget 'https://heibox.uni-heidelberg.de/f/867b05fc8c4841768640/?dl=1' -O 'server/models/taming/last.ckpt'"
@@ -59,11 +48,10 @@ class TamingDecoder:
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         print("USING ", self.device)
 
-        self.clip_model, self.clip_preprocess = clip.load(
+        self.clip_model, self.clip_preprocess = load_clip(
             "ViT-B/32",
             device=self.device,
         )
-        self.clip_model.eval()
         # NOTE: just adding the normalization transformation
         self.clip_transform = T.Compose([
             self.clip_preprocess.transforms[4],
@@ -78,15 +66,45 @@ class TamingDecoder:
             "server/models/taming/model.yaml",
             display=False,
         )
+        # NOTE: memory efficient attention in the encoder and decoder, see
+        # `difussion_models.AttnBlock`
+        config_xl.model.params.ddconfig.attn_type = attn_type
         self.vqgan_model = self.load_vqgan(
             config_xl,
-            ckpt_path="server/models.taming/last.ckpt",
+            ckpt_path="server/models/taming/last.ckpt",
         ).to(self.device)
-        
+        # NOTE: only the latents are optimized, so the weights can be shared
+        # between jobs without accumulating gradients
+        self.vqgan_model.requires_grad_(False)
+        self.vqgan_model.decoder.set_activation_checkpointing(
+            activation_checkpointing,
+            memory_budget_mb=activation_memory_budget_mb,
+        )
+
         self.aug_transform = torch.nn.Sequential(
             T.RandomHorizontalFlip(),
             T.RandomAffine(24, (.1, .1)),
-        ).cuda()
+        ).to(self.device)
+
+    def shared_modules(self, ):
+        """
+        Modules holding the weights of the model, see
+        `model_utils.share_model_memory`.
+        """
+        return [self.clip_model, self.vqgan_model]
+
+    def warmup(self, ):
+        warmup_clip(self.clip_model, device=self.device)
+
+        with torch.no_grad():
+            z_logits = torch.zeros(
+                1,
+                256,
+                self.embed_size,
+                self.embed_size,
+            ).to(self.device)
+            z = self.vqgan_model.post_quant_conv(z_logits)
+            self.vqgan_model.decoder(z)
 
     def augment(self, into, cutn=20): #into: 1x3x400x688
         crop_scaler = 1
@@ -96,22 +114,24 @@ class TamingDecoder:
 
         into = self.aug_transform(into) #RandomHorizontalFlip and RandomAffine
 
-        p_s = []
-        for ch in range(cutn):
-            size = int(torch.normal(1.2, .3, ()).clip(.43, 1.9) * self.target_img_size) #433
-            
-            if ch > cutn - 4:
-                size = int(self.target_img_size*1.4)
+        size = (torch.normal(1.2, .3, (cutn, )).clip(.43, 1.9) *
+                self.target_img_size).floor()
+        size[cutn - 3:] = int(self.target_img_size * 1.4)
 
-            offsetx = torch.randint(0, int(self.target_img_size*2 - size), ())
-            offsety = torch.randint(0, int(self.target_img_size*2 - size), ())
-            apper = into[:, :, offsetx:offsetx + size, offsety:offsety + size]
-            apper = torch.nn.functional.interpolate(apper, (int(224*crop_scaler), int(224*crop_scaler)), mode='bilinear', align_corners=True)
-            p_s.append(apper)
-        into = torch.cat(p_s, 0)
+        offset_range = self.target_img_size * 2 - size
+        offsetx = (torch.rand(cutn) * offset_range).floor()
+        offsety = (torch.rand(cutn) * offset_range).floor()
+
+        box_tensor = torch.stack([offsetx, offsety, size, size], -1)
+        into = crop_and_resize(
+            into,
+            box_tensor,
+            crop_size=int(224 * crop_scaler),
+            align_corners=True,
+        )
 
         up_noise = 0.11
-        into = into + up_noise*torch.rand((into.shape[0], 1, 1, 1)).cuda()*torch.randn_like(into, requires_grad=False)
+        into = into + up_noise*torch.rand((into.shape[0], 1, 1, 1)).to(self.device)*torch.randn_like(into, requires_grad=False)
 
         return into
 
@@ -146,11 +166,20 @@ class TamingDecoder:
     @staticmethod
     def load_vqgan(
         config,
-        ckpt_path=None,
+        ckpt_path="server/models/taming/last.ckpt",
+        inference_only=True,
     ):
+        """
+        With `inference_only` only the encoder, decoder and quantizer are
+        built, from a stripped copy of the checkpoint created on first use.
+        """
+        if inference_only:
+            return load_vq_inference_model(config, ckpt_path)
+
+        # NOTE: imported here, it pulls in PyTorch Lightning and the losses
+        from models.taming.vqgan import VQModel
         model = VQModel(**config.model.params)
 
-        ckpt_path = "server/models/taming/last.ckpt"
         if ckpt_path is not None:
             # XXX: check wtf is going on here
             sd = torch.load(ckpt_path, map_location="cpu")["state_dict"]
@@ -173,20 +202,29 @@ class TamingDecoder:
 
         return img_logits
 
-    def compute_clip_loss(self, img, text):
-        img_logits = self.get_clip_img_encodings(img)
+    def get_clip_text_encodings(self, text):
+        return encode_text(text, model_name="ViT-B/32", device=self.device)
 
-        tokenized_text = clip.tokenize([text]).to(self.device).detach().clone()
-        text_logits = self.clip_model.encode_text(tokenized_text)
+    def compute_clip_loss(self, img, text_logits):
+        """
+        `img` holds the crops of every sample in the batch, stacked crop
+        major as returned by `augment`, and `text_logits` one embedding per
+        sample. Returns the loss of each sample.
+        """
+        batch_size = text_logits.shape[0]
 
-        text_logits = text_logits / text_logits.norm(dim=-1, keepdim=True)
+        img_logits = self.get_clip_img_encodings(img)
+        img_logits = img_logits.view(-1, batch_size, img_logits.shape[-1])
 
-        loss = -torch.cosine_similarity(text_logits, img_logits).mean()
+        loss = -torch.cosine_similarity(
+            text_logits[None],
+            img_logits,
+            dim=-1,
+        ).mean(0)
 
         return loss
 
-
-    def generate_from_prompt(
+    def init_session(
         self,
         prompt: str,
         lr: float = 0.5,
@@ -202,19 +240,15 @@ class TamingDecoder:
             256,
             self.embed_size,
             self.embed_size,
-        ).cuda()
+        ).to(self.device)
 
         z_logits = torch.nn.Parameter(
             torch.sinh(1.9 * torch.arcsinh(z_logits)), )
 
         if img_batch is not None:
-            clip_img_z_logits = self.get_clip_img_encodings(img_batch)
-            clip_img_z_logits = clip_img_z_logits.detach().clone()
-
             z, _, [_, _, indices] = self.vqgan_model.encode(img_batch)
 
             z_logits = torch.nn.Parameter(z)
-            img_z_logits = z.detach().clone()
 
         optimizer = torch.optim.AdamW(
             params=[z_logits],
@@ -223,81 +257,195 @@ class TamingDecoder:
             weight_decay=0.1,
         )
 
-        gen_img_list = []
-        z_logits_list = []
+        session = GenerationSession(
+            prompt=prompt,
+            latents=z_logits,
+            optimizer=optimizer,
+            text_logits=self.get_clip_text_encodings(prompt),
+            num_steps=num_generations,
+            img_save_freq=img_save_freq,
+        )
 
-        for step in range(num_generations):
-            loss = 0
-            
-            if step % img_save_freq == 0:
-                print("Adding logits...")
-                z_logits_list.append(z_logits.detach().clone())
+        return session
 
-            z = self.vqgan_model.post_quant_conv(z_logits)
-            x_rec = self.vqgan_model.decoder(z)
-            x_rec = (x_rec.clip(-1, 1) + 1) / 2
-            x_rec_stacked = self.augment(x_rec)
+    def warm_start_session(
+        self,
+        session: GenerationSession,
+        latents,
+        noise_frac: float = 0.,
+    ):
+        """
+        Starts `session` from the final latents of a previous session, blended
+        with a `noise_frac` fraction of its own random initialization.
+        """
+        with torch.no_grad():
+            session.latents.copy_((1 - noise_frac) *
+                                  latents.to(session.latents.device) +
+                                  noise_frac * session.latents)
+
+    def batched_step(
+        self,
+        session_list: List[GenerationSession],
+    ):
+        for session in session_list:
+            if session.step % session.img_save_freq == 0:
+                session.add_feat(session.latents.detach().clone())
+
+        z_logits = torch.cat([session.latents for session in session_list])
+        text_logits = torch.cat([
+            session.text_logits.expand(session.latents.shape[0], -1)
+            for session in session_list
+        ])
 
-            # x_rec_stacked = get_stacked_random_crops(
-            #     img=x_rec,
-            #     num_random_crops=num_random_crops,
-            # )
+        z = self.vqgan_model.post_quant_conv(z_logits)
+        x_rec = self.vqgan_model.decoder(z)
+        x_rec = (x_rec.clip(-1, 1) + 1) / 2
+        x_rec_stacked = self.augment(x_rec)
 
-            loss += 10 * self.compute_clip_loss(x_rec_stacked, prompt)
+        sample_loss = 10 * self.compute_clip_loss(x_rec_stacked, text_logits)
 
-            # if img_batch is not None:
-            #     loss += -10 * torch.cosine_similarity(z_logits,
-            #                                           img_z_logits).mean()
-            # if img_batch is not None:
-            #     loss += -10 * torch.cosine_similarity(
-            #         self.get_clip_img_encodings(x_rec), clip_img_z_logits).mean()
+        split_size_list = [session.latents.shape[0] for session in session_list]
+        session_loss_list = [
+            session_sample_loss.mean()
+            for session_sample_loss in sample_loss.split(split_size_list)
+        ]
 
-            print(loss)
+        for session in session_list:
+            session.optimizer.zero_grad()
 
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+        torch.stack(session_loss_list).sum().backward()
 
-            if step % img_save_freq == 0:
-                print("Adding img...")
-                x_rec_img = T.ToPILImage(mode='RGB')(x_rec[0])
-                gen_img_list.append(x_rec_img)
+        x_rec_list = x_rec.detach().split(split_size_list)
+        for session, session_loss, session_x_rec in zip(
+                session_list, session_loss_list, x_rec_list):
+            session.optimizer.step()
+            session.loss = session_loss.item()
+            print(f"Loss {session.loss}")
 
-                x_rec_img.save(f"generations/{step}.png")
+            if session.step % session.img_save_freq == 0:
+                x_rec_img = T.ToPILImage(mode='RGB')(session_x_rec[0])
+                session.add_frame(x_rec_img)
 
-            torch.cuda.empty_cache()
+            session.step += 1
 
-        torch.save(z_logits, f'{prompt}_logits.pt')
+        torch.cuda.empty_cache()
 
-        return gen_img_list, z_logits_list
+    def generate_from_prompt(
+        self,
+        prompt: str,
+        lr: float = 0.5,
+        img_save_freq: int = 1,
+        num_generations: int = 100,
+        num_random_crops: int = 32,
+        img_batch=None,
+        callback_list: List[Callable] = None,
+        frame_sink_list: List = None,
+        keep_all_frames: bool = True,
+    ):
+        session = self.init_session(
+            prompt=prompt,
+            lr=lr,
+            img_save_freq=img_save_freq,
+            num_generations=num_generations,
+            num_random_crops=num_random_crops,
+            img_batch=img_batch,
+        )
+
+        if callback_list is not None:
+            session.callback_list = callback_list
+        if frame_sink_list is not None:
+            session.frame_sink_list = frame_sink_list
+        session.keep_all_frames = keep_all_frames
+
+        return run_session(self.batched_step, session)
+
+    def decode(self, z_logits):
+        z = self.vqgan_model.post_quant_conv(z_logits)
+        x_rec = self.vqgan_model.decoder(z)
+        x_rec = (x_rec.clip(-1, 1) + 1) / 2
+
+        return x_rec
 
     def interpolate(
         self,
         z_logits_list,
         duration_list,
+        frame_sink_list: List = None,
+        keep_all_frames: bool = True,
+        should_stop: Callable = None,
     ):
-        gen_img_list = []
-        fps = 25
+        return render_interpolation(
+            z_logits_list,
+            duration_list,
+            decode=self.decode,
+            frame_sink_list=frame_sink_list,
+            keep_all_frames=keep_all_frames,
+            should_stop=should_stop,
+        )
 
-        for idx, (z_logits,
-                  duration) in enumerate(zip(z_logits_list, duration_list)):
-            num_steps = int(duration * fps)
-            z_logits_1 = z_logits
-            z_logits_2 = z_logits_list[(idx + 1) % len(z_logits_list)]
+    def zoom_z_logits(
+        self,
+        z_logits,
+        zoom_offset: int,
+        mode: str = 'bilinear',
+    ):
+        """
+        Zooms into the latent grid, cropping `zoom_offset` pixels from every
+        side of the decoded image and rescaling, without the decode-encode
+        round trip.
+
+        NOTE: bilinear by default, `grid_sample` has no bicubic mode before
+        torch 1.8.
+        """
+        # NOTE: every latent covers a `downsample_factor` pixels wide patch
+        downsample_factor = 2**(self.vqgan_model.decoder.num_resolutions - 1)
+        latent_offset = zoom_offset / downsample_factor
+        embed_height, embed_width = z_logits.shape[2:]
+
+        box_tensor = torch.tensor([[
+            latent_offset,
+            latent_offset,
+            embed_height - 2 * latent_offset,
+            embed_width - 2 * latent_offset,
+        ]])
+
+        return crop_and_resize(
+            z_logits,
+            box_tensor,
+            crop_size=embed_height,
+            mode=mode,
+            align_corners=False,
+        )
 
-            for step in range(num_steps):
-                weight = math.sin(1.5708 * step / num_steps)**2
-                z_logits = weight * z_logits_2 + (1 - weight) * z_logits_1
+    def zoom_z_logits_from_pixels(
+        self,
+        z_logits,
+        zoom_offset: int,
+    ):
+        """
+        Decodes `z_logits`, zooms into the image and encodes it back, which
+        snaps the latents onto the codebook and corrects the drift of the
+        latent zoom.
+        """
+        z = self.vqgan_model.post_quant_conv(z_logits)
+        x_rec = self.vqgan_model.decoder(z)
+        x_rec = (x_rec.clip(-1, 1) + 1) / 2
+
+        x_rec_size = x_rec.shape[-1]
+
+        x_rec_zoom = x_rec[:, :, zoom_offset:-zoom_offset,
+                           zoom_offset:-zoom_offset]
+        x_rec_zoom = torch.nn.functional.interpolate(
+            x_rec_zoom,
+            (x_rec_size, x_rec_size),
+            mode="bilinear",
+        )
 
-                z = self.vqgan_model.post_quant_conv(z_logits)
-                x_rec = self.vqgan_model.decoder(z)
-                x_rec = (x_rec.clip(-1, 1) + 1) / 2
+        x_rec_zoom = 2. * x_rec_zoom - 1
+        zoom_z_logits, _, [_, _, indices] = self.vqgan_model.encode(x_rec_zoom)
 
-                x_rec_img = T.ToPILImage(mode='RGB')(x_rec[0])
-                gen_img_list.append(x_rec_img)
+        return zoom_z_logits
 
-        return gen_img_list
-    
     def generate_video_from_prompt(
         self,
         prompt: str,
@@ -308,7 +456,22 @@ class TamingDecoder:
         num_zoom_interp_steps=4,
         num_zoom_train_steps=4,
         zoom_offset = 16,
+        reencode_freq: int = 8,
+        frame_sink_list: List = None,
+        keep_all_frames: bool = True,
     ):
+        """
+        Zoom video, frames are handed to `frame_sink_list` as soon as they are
+        decoded. With `keep_all_frames` set to False only the last frame is
+        returned, so long runs do not hold every frame in memory.
+
+        The zoom is applied to the latent grid, and only every
+        `reencode_freq` steps through a decode-encode round trip. Set
+        `reencode_freq` to 1 to always zoom in pixel space.
+        """
+        if frame_sink_list is None:
+            frame_sink_list = []
+
         z_logits = init_latent.detach().clone()
         z_logits = torch.nn.Parameter(z_logits)
 
@@ -318,25 +481,21 @@ class TamingDecoder:
             betas=(0.9, 0.999),
             weight_decay=0.1,
         )
-                
+
+        text_logits = self.get_clip_text_encodings(prompt)
 
         gen_img_list = []
         z_logits_list = []
         for step in range(num_generations):
             with torch.no_grad():
+                if step % reencode_freq == 0:
+                    zoom_z_logits = self.zoom_z_logits_from_pixels(
+                        z_logits,
+                        zoom_offset,
+                    )
+                else:
+                    zoom_z_logits = self.zoom_z_logits(z_logits, zoom_offset)
 
-                z = self.vqgan_model.post_quant_conv(z_logits)
-                x_rec = self.vqgan_model.decoder(z)
-                x_rec = (x_rec.clip(-1, 1) + 1) / 2
-                
-                x_rec_size = x_rec.shape[-1]
-
-                x_rec_zoom = x_rec[:, :, zoom_offset:-zoom_offset, zoom_offset:-zoom_offset]
-                x_rec_zoom = torch.nn.functional.interpolate(x_rec_zoom, (x_rec_size, x_rec_size), mode="bilinear",)
-                
-                x_rec_zoom = 2. * x_rec_zoom - 1
-                zoom_z_logits, _, [_, _, indices] = self.vqgan_model.encode(x_rec_zoom)
-                
                 z_logits.data = zoom_z_logits.clone().detach()
 
             for zoom_train_step in range(num_zoom_train_steps):
@@ -346,7 +505,7 @@ class TamingDecoder:
                 x_rec = (x_rec.clip(-1, 1) + 1) / 2
                 x_rec_stacked = self.augment(x_rec,)
 
-                loss += 10 * self.compute_clip_loss(x_rec_stacked, prompt)
+                loss += 10 * self.compute_clip_loss(x_rec_stacked, text_logits)
 
                 print(loss)
 
@@ -372,7 +531,13 @@ class TamingDecoder:
                     
                 print("Adding img...")
                 x_rec_img = T.ToPILImage(mode='RGB')(x_rec[0])
-                gen_img_list.append(x_rec_img)
+                if keep_all_frames:
+                    gen_img_list.append(x_rec_img)
+                else:
+                    gen_img_list = [x_rec_img]
+
+                for frame_sink in frame_sink_list:
+                    frame_sink.add_frame(x_rec_img)
 
                 x_rec_img.save(f"generations/{step}_{zoom_step}.jpg")
 
@@ -403,17 +568,17 @@ if __name__ == '__main__':
     # img = dalle_img_preprocess(img)
     prompt='Creepy Disney ghosts dancing in the fire'
 
-    # gen_img_list, z_logits_list = taming_decoder.generate_from_prompt(
-    #     prompt=prompt,
-    #     img_batch=img,
-    #     lr=0.5,
-    #     num_generations=200,
-    # )
-    
-    # torch.cuda.empty_cache()
-    
-    init_latent_path = f"./{prompt}_logits.pt"
-    init_latent = torch.load(init_latent_path).to('cuda')
+    # NOTE: the zoom starts from the latents of a regular generation
+    gen_img_list, z_logits_list = taming_decoder.generate_from_prompt(
+        prompt=prompt,
+        img_batch=img,
+        lr=0.5,
+        num_generations=200,
+    )
+
+    torch.cuda.empty_cache()
+
+    init_latent = z_logits_list[-1]
     gen_img_list, z_logits_list = taming_decoder.generate_video_from_prompt(
         prompt=prompt,
         init_latent=init_latent,
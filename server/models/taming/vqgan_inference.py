@@ -0,0 +1,109 @@
+import os
+from typing import *
+
+import torch
+
+from models.checkpoints import (
+    save_state_dict_file,
+    load_state_dict_file,
+    load_weights,
+)
+from models.taming.difussion_models import Encoder, Decoder
+from models.taming.quantize import VectorQuantizer
+
+# NOTE: the only parts of a `VQModel` checkpoint needed for inference, the
+# rest is the LPIPS loss, the discriminator and the optimizer states
+INFERENCE_PREFIX_LIST = [
+    'encoder.',
+    'decoder.',
+    'quantize.',
+    'quant_conv.',
+    'post_quant_conv.',
+]
+
+
+class VQInferenceModel(torch.nn.Module):
+    """
+    Inference only counterpart of `vqgan.VQModel`, with the same encode and
+    decode API and state dict keys, but without the loss modules or the
+    PyTorch Lightning machinery.
+    """
+    def __init__(
+        self,
+        ddconfig,
+        n_embed: int,
+        embed_dim: int,
+        **ignore_kwargs,
+    ):
+        super().__init__()
+        self.encoder = Encoder(**ddconfig)
+        self.decoder = Decoder(**ddconfig)
+        self.quantize = VectorQuantizer(n_embed, embed_dim, beta=0.25)
+        self.quant_conv = torch.nn.Conv2d(ddconfig["z_channels"], embed_dim, 1)
+        self.post_quant_conv = torch.nn.Conv2d(
+            embed_dim,
+            ddconfig["z_channels"],
+            1,
+        )
+
+    def encode(self, x):
+        h = self.encoder(x)
+        h = self.quant_conv(h)
+        quant, emb_loss, info = self.quantize(h)
+        return quant, emb_loss, info
+
+    def decode(self, quant):
+        quant = self.post_quant_conv(quant)
+        dec = self.decoder(quant)
+        return dec
+
+    def decode_code(self, code_b):
+        quant_b = self.quantize.embed_code(code_b)
+        dec = self.decode(quant_b)
+        return dec
+
+    def forward(self, input):
+        quant, diff, _ = self.encode(input)
+        dec = self.decode(quant)
+        return dec, diff
+
+
+def get_stripped_ckpt_path(ckpt_path: str, ) -> str:
+    return f"{os.path.splitext(ckpt_path)[0]}.inference.pt"
+
+
+def strip_checkpoint(
+    ckpt_path: str,
+    stripped_ckpt_path: str,
+):
+    """
+    Converts a Lightning checkpoint into a file holding only the inference
+    weights, written atomically.
+    """
+    print(f"Stripping {ckpt_path} into {stripped_ckpt_path}...")
+    state_dict = torch.load(ckpt_path, map_location="cpu")["state_dict"]
+    state_dict = {
+        key: value
+        for key, value in state_dict.items()
+        if any(key.startswith(prefix) for prefix in INFERENCE_PREFIX_LIST)
+    }
+
+    save_state_dict_file(state_dict, stripped_ckpt_path)
+
+
+def load_vq_inference_model(
+    config,
+    ckpt_path: str,
+):
+    stripped_ckpt_path = get_stripped_ckpt_path(ckpt_path)
+    if not os.path.exists(stripped_ckpt_path):
+        strip_checkpoint(ckpt_path, stripped_ckpt_path)
+
+    model = VQInferenceModel(**config.model.params)
+
+    state_dict = load_state_dict_file(stripped_ckpt_path)
+    missing, unexpected = load_weights(model, state_dict, strict=False)
+    if len(missing) > 0:
+        print(f"Missing VQGAN weights: {missing}")
+
+    return model.eval()
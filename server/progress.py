@@ -0,0 +1,120 @@
+import json
+import time
+import datetime
+from typing import *
+
+# NOTE: the latest event is also stored so that clients subscribing in the
+# middle of a job get the current state right away
+PROGRESS_TTL = 5000
+
+
+def get_progress_channel(job_id: str) -> str:
+    return f"progress:{job_id}"
+
+
+def get_latest_progress_key(job_id: str) -> str:
+    return f"progress-latest:{job_id}"
+
+
+def publish_progress(
+    conn,
+    job_id: str,
+    event: Dict,
+):
+    # NOTE: job ids are reused by identical requests, the time tells events of
+    # the current run from those left by a previous one
+    event_json = json.dumps({**event, 'publishedAt': time.time()})
+
+    with conn.pipeline() as pipeline:
+        pipeline.set(
+            get_latest_progress_key(job_id),
+            event_json,
+            ex=PROGRESS_TTL,
+        )
+        pipeline.publish(get_progress_channel(job_id), event_json)
+        pipeline.execute()
+
+
+def publish_result(
+    conn,
+    job_id: str,
+    result: Dict,
+):
+    publish_progress(
+        conn,
+        job_id,
+        {
+            'finished': True,
+            'result': result,
+        },
+    )
+
+
+def get_latest_progress(
+    conn,
+    job_id: str,
+):
+    event_json = conn.get(get_latest_progress_key(job_id))
+    if event_json is None:
+        return None
+
+    return json.loads(event_json)
+
+
+class ProgressReporter:
+    """
+    Session callback publishing the progress of a job after every step.
+    """
+    def __init__(
+        self,
+        conn,
+        job_id: str,
+        prompt_idx: int = 0,
+        num_prompts: int = 1,
+        preview_sink=None,
+    ):
+        self.conn = conn
+        self.job_id = job_id
+        self.prompt_idx = prompt_idx
+        self.num_prompts = num_prompts
+        self.preview_sink = preview_sink
+
+    def __call__(self, session):
+        event = {
+            'finished': False,
+            'step': session.step,
+            'numSteps': session.num_steps,
+            'loss': session.loss,
+            'converged': session.converged,
+            'promptIdx': self.prompt_idx,
+            'numPrompts': self.num_prompts,
+            'previewUrl': '',
+        }
+        if self.preview_sink is not None:
+            event['previewUrl'] = self.preview_sink.preview_url
+
+        publish_progress(self.conn, self.job_id, event)
+
+
+def clear_progress(
+    conn,
+    job_id: str,
+):
+    conn.delete(get_latest_progress_key(job_id))
+
+
+def is_current_event(
+    event: Dict,
+    enqueued_at,
+) -> bool:
+    """
+    Whether `event` was published after the job was enqueued at
+    `enqueued_at` (a naive UTC datetime, as stored by RQ).
+    """
+    if enqueued_at is None:
+        return True
+
+    enqueued_timestamp = enqueued_at.replace(
+        tzinfo=datetime.timezone.utc).timestamp()
+
+    return event.get('publishedAt', 0) >= enqueued_timestamp
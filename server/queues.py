@@ -0,0 +1,50 @@
+import os
+from typing import *
+
+# NOTE: listed from most to least urgent, workers drain them in this order
+PRIORITY_LIST = ['interactive', 'batch']
+
+# NOTE: single generations up to this many iterations are served as
+# interactive previews, longer ones and stories go to the batch tier
+INTERACTIVE_MAX_ITERATIONS = int(os.getenv('INTERACTIVE_MAX_ITERATIONS', '100'))
+
+DEFAULT_QUEUE_NAME = 'default'
+
+
+def get_queue_name(
+    model: str,
+    priority: str,
+) -> str:
+    return f"{model}-{priority}"
+
+
+def get_job_priority(
+    story_generation: bool,
+    num_iterations: int,
+) -> str:
+    if story_generation or num_iterations > INTERACTIVE_MAX_ITERATIONS:
+        return 'batch'
+
+    return 'interactive'
+
+
+def get_worker_queue_name_list(
+    model_list: List[str],
+    priority_list: List[str] = PRIORITY_LIST,
+) -> List[str]:
+    """
+    Queues a worker pinned to `model_list` listens on. Every interactive
+    queue comes before any batch queue, so a worker serving several models
+    always picks up short jobs first. The legacy `default` queue is last.
+    """
+    priority_list = [
+        priority for priority in PRIORITY_LIST if priority in priority_list
+    ]
+    queue_name_list = [
+        get_queue_name(model, priority)
+        for priority in priority_list
+        for model in model_list
+    ]
+    queue_name_list.append(DEFAULT_QUEUE_NAME)
+
+    return queue_name_list
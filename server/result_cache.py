@@ -0,0 +1,76 @@
+import os
+import json
+import hashlib
+from typing import *
+
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', str(7 * 24 * 3600)))
+INFLIGHT_TTL = 5000
+
+
+def get_request_fingerprint(request_dict: Dict) -> str:
+    """
+    Hash of everything that determines the output of a generation request.
+    Conditioning images are referenced by their content-addressed blob id.
+    """
+    request_json = json.dumps(
+        request_dict,
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+
+    return hashlib.sha256(request_json.encode('utf-8')).hexdigest()
+
+
+def get_result_key(fingerprint: str) -> str:
+    return f"result:{fingerprint}"
+
+
+def get_inflight_key(fingerprint: str) -> str:
+    return f"inflight:{fingerprint}"
+
+
+def get_cached_result(
+    conn,
+    fingerprint: str,
+):
+    result_json = conn.get(get_result_key(fingerprint))
+    if result_json is None:
+        return None
+
+    return json.loads(result_json)
+
+
+def cache_result(
+    conn,
+    fingerprint: str,
+    result: Dict,
+):
+    conn.set(
+        get_result_key(fingerprint),
+        json.dumps(result),
+        ex=RESULT_CACHE_TTL,
+    )
+
+
+def claim_inflight(
+    conn,
+    fingerprint: str,
+) -> bool:
+    """
+    Returns True if the caller is the first one to run this request, False
+    if a job for it is already queued or running.
+    """
+    return bool(
+        conn.set(
+            get_inflight_key(fingerprint),
+            1,
+            nx=True,
+            ex=INFLIGHT_TTL,
+        ))
+
+
+def release_inflight(
+    conn,
+    fingerprint: str,
+):
+    conn.delete(get_inflight_key(fingerprint))
@@ -0,0 +1,211 @@
+import sys
+import traceback
+from typing import *
+
+from rq import SimpleWorker
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from rq.utils import utcnow
+from rq.worker import WorkerStatus
+
+import server_utils
+from model_utils import get_model
+from models.session import step_sessions
+
+BATCHABLE_FUNC_NAME = 'server_utils.single_generation'
+
+
+class BatchingWorker(SimpleWorker):
+    """
+    RQ worker that packs compatible single generation jobs (same model and
+    resolution) into one running optimization batch. Every step it claims
+    compatible jobs waiting in its queues, so jobs join and leave the batch
+    as they start and finish. Any other job is executed in this process too,
+    like `SimpleWorker` does, since the models are resident.
+
+    NOTE: the RQ job timeout is not enforced for batched jobs.
+    """
+    def __init__(
+        self,
+        *args,
+        max_batch_size: int = 4,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.max_batch_size = max_batch_size
+
+        self.batch_key = None
+        # NOTE: list of `(job, queue, session)` being optimized
+        self.active_list = []
+
+    @staticmethod
+    def get_job_batch_key(job: Job, ):
+        if job.func_name != BATCHABLE_FUNC_NAME:
+            return None
+
+        return server_utils.get_batch_key(*job.args, **job.kwargs)
+
+    def execute_job(
+        self,
+        job: Job,
+        queue,
+    ):
+        batch_key = self.get_job_batch_key(job)
+        if batch_key is None:
+            return super().execute_job(job, queue)
+
+        self.set_state(WorkerStatus.BUSY)
+        self.batch_key = batch_key
+        self.admit_job(job, queue)
+
+        while len(self.active_list) > 0:
+            self.claim_compatible_jobs()
+            self.run_batch_step()
+            self.heartbeat()
+
+        self.batch_key = None
+
+    def admit_job(
+        self,
+        job: Job,
+        queue,
+    ):
+        self.prepare_job_execution(job)
+        job.started_at = utcnow()
+
+        try:
+            session = server_utils.init_single_session(*job.args, **job.kwargs)
+        except Exception:
+            self.fail_job(job, queue, sys.exc_info())
+            return
+
+        callback_list, frame_sink_list = server_utils.get_job_reporting(
+            self.connection,
+            job.id,
+            session.extra['out_dir'],
+        )
+        session.callback_list.extend(callback_list)
+        session.frame_sink_list.extend(frame_sink_list)
+
+        self.active_list.append((job, queue, session))
+        print(f"Job {job.id} joined the batch ({len(self.active_list)} jobs)")
+
+    def claim_compatible_jobs(self, ):
+        """
+        Claims waiting jobs with the same batch key as the running batch. A
+        job is only taken out of its queue if this worker removed it first.
+        """
+        for queue in self.queues:
+            num_free_slots = self.max_batch_size - len(self.active_list)
+            if num_free_slots <= 0:
+                return
+
+            for job_id in queue.get_job_ids(0, 4 * self.max_batch_size):
+                if len(self.active_list) >= self.max_batch_size:
+                    return
+
+                try:
+                    job = self.job_class.fetch(
+                        job_id,
+                        connection=self.connection,
+                    )
+                except NoSuchJobError:
+                    continue
+
+                if self.get_job_batch_key(job) != self.batch_key:
+                    continue
+
+                if queue.remove(job_id) == 0:
+                    # NOTE: claimed by another worker
+                    continue
+
+                self.admit_job(job, queue)
+
+    def run_batch_step(self, ):
+        model = self.batch_key[0]
+        session_list = [session for _job, _queue, session in self.active_list]
+
+        try:
+            step_sessions(get_model(model).batched_step, session_list)
+        except Exception:
+            exc_info = sys.exc_info()
+            for job, queue, session in self.active_list:
+                self.close_session(session)
+                self.fail_job(job, queue, exc_info)
+            self.active_list = []
+            self.update_current_job()
+            return
+
+        running_list = []
+        for job, queue, session in self.active_list:
+            if not session.finished:
+                running_list.append((job, queue, session))
+                continue
+
+            try:
+                result = server_utils.finalize_single_generation(session)
+            except Exception:
+                self.fail_job(job, queue, sys.exc_info())
+                continue
+
+            server_utils.finish_job(self.connection, job.id, result)
+
+            job.ended_at = utcnow()
+            job._result = result
+            self.handle_job_success(
+                job=job,
+                queue=queue,
+                started_job_registry=queue.started_job_registry,
+            )
+            print(f"Job {job.id} left the batch")
+
+        self.active_list = running_list
+        self.update_current_job()
+
+    def update_current_job(self, ):
+        """
+        RQ clears the current job of the worker when any job ends, it is set
+        back to a job still in the batch so monitoring shows the worker busy.
+        """
+        if len(self.active_list) > 0:
+            self.set_current_job_id(self.active_list[0][0].id)
+        else:
+            self.set_current_job_id(None)
+
+    @staticmethod
+    def close_session(session, ):
+        """
+        Stops the frame sinks of a failed session, their encoder threads would
+        otherwise outlive it in this long running process.
+        """
+        try:
+            session.close_frame_sinks()
+        except Exception:
+            traceback.print_exc()
+
+    def fail_job(
+        self,
+        job: Job,
+        queue,
+        exc_info,
+    ):
+        # NOTE: also releases the inflight claim, so identical requests do
+        # not keep attaching to the failed job
+        server_utils.finish_job(
+            self.connection,
+            job.id,
+            {
+                'success': False,
+                'error': str(exc_info[1]),
+            },
+        )
+
+        job.ended_at = utcnow()
+        exc_string = ''.join(traceback.format_exception(*exc_info))
+        self.handle_job_failure(
+            job=job,
+            started_job_registry=queue.started_job_registry,
+            exc_string=exc_string,
+        )
+        self.handle_exception(job, *exc_info)
+        self.update_current_job()
@@ -1,26 +1,58 @@
 import os
+import json
 import base64
 from io import BytesIO
 from typing import *
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from rq import Queue
 from rq.job import Job
+from rq.exceptions import NoSuchJobError
 from PIL import Image
 
 from worker import conn
-from server_utils import single_generation, story_generation
+from blob_store import save_blob, save_blob_from_stream, is_blob_id
+from progress import (
+    get_progress_channel,
+    get_latest_progress,
+    publish_result,
+    clear_progress,
+    is_current_event,
+)
+from frame_sinks import get_preview_key
+from model_utils import MODEL_LIST
+from queues import get_queue_name, get_job_priority
+from job_control import set_control, clear_control, STOP, CANCEL
+from result_cache import (
+    get_request_fingerprint,
+    get_cached_result,
+    claim_inflight,
+    release_inflight,
+)
 
 app = Flask(__name__)
 app.app_context().push()
 
-q = Queue(connection=conn)
+# NOTE: one queue per model and priority tier, see `queues.py`
+queue_dict = {}
+
+# NOTE: job functions are referenced by import path so that the API never
+# imports `server_utils` and the ML stack behind it, only the workers do
+SINGLE_GENERATION_FUNC = 'server_utils.single_generation'
+STORY_GENERATION_FUNC = 'server_utils.story_generation'
 
 
 def base64_to_PIL(base64_encoding: str):
     return Image.open(BytesIO(base64.b64decode(base64_encoding)))
 
 
+def base64_to_blob(data_uri: str):
+    """
+    Stores a base64 data URI in the blob store without decoding the image.
+    """
+    return save_blob(base64.b64decode(data_uri.split('base64')[1]))
+
+
 def PIL_to_base64(img):
     buffer = BytesIO()
     # img = remove_background(img)
@@ -31,14 +63,102 @@ def PIL_to_base64(img):
     return data_uri
 
 
+def get_queue(queue_name: str, ):
+    if queue_name not in queue_dict:
+        queue_dict[queue_name] = Queue(queue_name, connection=conn)
+
+    return queue_dict[queue_name]
+
+
+def enqueue_generation(
+    func: str,
+    args: Tuple,
+    fingerprint: str,
+    queue_name: str,
+) -> bool:
+    """
+    Enqueues a generation job named after the request fingerprint, unless its
+    result is already stored or an identical job is queued or running, in
+    which case the caller attaches to it. Returns whether a job was enqueued.
+    """
+    if get_cached_result(conn, fingerprint) is not None:
+        return False
+
+    if not claim_inflight(conn, fingerprint):
+        try:
+            job = Job.fetch(fingerprint, connection=conn)
+        except NoSuchJobError:
+            job = None
+
+        if job is not None and job.get_status() not in ('failed', 'canceled'):
+            return False
+
+        # NOTE: stale claim left by a failed or cancelled job, or by a request
+        # that died before enqueuing its job
+        release_inflight(conn, fingerprint)
+        if not claim_inflight(conn, fingerprint):
+            return False
+
+    # NOTE: job ids are reused by identical requests, drop the stop or cancel
+    # flag, the final progress event and the preview a previous run may have
+    # left
+    clear_control(conn, fingerprint)
+    clear_progress(conn, fingerprint)
+    conn.delete(get_preview_key(fingerprint))
+
+    get_queue(queue_name).enqueue_call(
+        func=func,
+        args=args,
+        job_id=fingerprint,
+        result_ttl=5000,
+        timeout=5000,
+    )
+
+    return True
+
+
 @app.route("/results/<job_key>", methods=['GET'])
 def get_results(job_key):
-    job = Job.fetch(job_key, connection=conn)
+    cached_result = get_cached_result(conn, job_key)
+    if cached_result is not None:
+        response = cached_result
+        response['finished'] = "yup"
+        json_response = jsonify(response)
+        json_response.headers.add('Access-Control-Allow-Origin', '*')
+
+        return json_response
+
+    try:
+        job = Job.fetch(job_key, connection=conn)
+    except NoSuchJobError:
+        # NOTE: a claim whose job was never enqueued would keep identical
+        # requests attached to it until it expires
+        release_inflight(conn, job_key)
+
+        json_response = jsonify(
+            success=False,
+            error="JOB NOT FOUND",
+            finished="yup",
+        )
+        json_response.status_code = 404
+        json_response.headers.add('Access-Control-Allow-Origin', '*')
+
+        return json_response
+
+    latest_progress = get_latest_progress(conn, job_key)
+    # NOTE: ignores the final event of a previous run of the same request
+    if latest_progress is not None and not is_current_event(
+            latest_progress, job.enqueued_at):
+        latest_progress = None
 
     print(job.is_finished)
     if job.is_finished:
         response = job.result
         response['finished'] = "yup"
+    elif latest_progress is not None and latest_progress['finished']:
+        # NOTE: cancelled before being picked up by a worker
+        response = latest_progress['result']
+        response['finished'] = "yup"
     else:
         response = {
             "finished": "Not yet bro!",
@@ -51,96 +171,373 @@ def get_results(job_key):
     return json_response
 
 
+@app.route("/progress/<job_key>", methods=['GET'])
+def stream_progress(job_key):
+    """
+    Server-Sent Events stream with the progress of a job, relayed from the
+    Redis channel the worker publishes to after every step. The last event
+    has `finished` set and holds the result of the job.
+    """
+    def event_stream():
+        pubsub = conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(get_progress_channel(job_key))
+
+        try:
+            cached_result = get_cached_result(conn, job_key)
+            if cached_result is not None:
+                event = {'finished': True, 'result': cached_result}
+                yield f"data: {json.dumps(event)}\n\n"
+                return
+
+            try:
+                job = Job.fetch(job_key, connection=conn)
+            except NoSuchJobError:
+                job = None
+
+            # NOTE: subscribed before checking the job, so no event is lost
+            latest_progress = get_latest_progress(conn, job_key)
+            if latest_progress is not None and job is not None and \
+                    not is_current_event(latest_progress, job.enqueued_at):
+                latest_progress = None
+
+            if latest_progress is not None:
+                yield f"data: {json.dumps(latest_progress)}\n\n"
+                if latest_progress['finished']:
+                    return
+
+            while True:
+                message = pubsub.get_message(timeout=15)
+                if message is None:
+                    try:
+                        job = Job.fetch(job_key, connection=conn)
+                    except NoSuchJobError:
+                        job = None
+
+                    if job is None or job.is_finished or job.is_failed:
+                        if job is not None and job.is_finished:
+                            result = job.result
+                        else:
+                            result = {
+                                'success': False,
+                                'error': 'JOB FAILED',
+                            }
+                        event = {'finished': True, 'result': result}
+                        yield f"data: {json.dumps(event)}\n\n"
+                        return
+
+                    # NOTE: keeps the connection alive through proxies
+                    yield ": keepalive\n\n"
+                    continue
+
+                event_json = message['data'].decode('utf-8')
+                yield f"data: {event_json}\n\n"
+
+                if json.loads(event_json)['finished']:
+                    return
+
+        finally:
+            pubsub.close()
+
+    response = Response(
+        stream_with_context(event_stream()),
+        mimetype='text/event-stream',
+    )
+    response.headers.add('Access-Control-Allow-Origin', '*')
+    response.headers.add('Cache-Control', 'no-cache')
+    response.headers.add('X-Accel-Buffering', 'no')
+
+    return response
+
+
+@app.route("/preview/<job_key>", methods=['GET'])
+def get_preview(job_key):
+    """
+    Latest preview frame of a running job as a JPEG.
+    """
+    preview_bytes = conn.get(get_preview_key(job_key))
+    if preview_bytes is None:
+        response = jsonify(
+            success=False,
+            error="NO PREVIEW YET",
+        )
+        response.status_code = 404
+    else:
+        response = Response(preview_bytes, mimetype='image/jpeg')
+        response.headers.add('Cache-Control', 'no-cache')
+
+    response.headers.add('Access-Control-Allow-Origin', '*')
+
+    return response
+
+
+def control_job(
+    job_key: str,
+    control: str,
+):
+    """
+    Flags a job to be stopped or cancelled by its worker after the current
+    step. Jobs still waiting in their queue have no frames to keep, they are
+    cancelled right away whatever the control and the response has
+    `cancelled` set.
+    """
+    try:
+        job = Job.fetch(job_key, connection=conn)
+    except NoSuchJobError:
+        job = None
+
+    if job is None:
+        response = jsonify(
+            success=False,
+            error="JOB NOT FOUND",
+        )
+        response.status_code = 404
+    elif job.is_finished or job.is_failed:
+        response = jsonify(
+            success=False,
+            error="JOB ALREADY FINISHED",
+        )
+    else:
+        # NOTE: flagged first so that a job dequeued in the meantime still
+        # sees it after its first step
+        set_control(conn, job_key, control)
+
+        if job.is_queued:
+            job.cancel()
+            publish_result(
+                conn,
+                job_key,
+                {
+                    'success': False,
+                    'error': "JOB CANCELLED",
+                },
+            )
+            release_inflight(conn, job_key)
+
+            response = jsonify(
+                success=True,
+                cancelled=True,
+            )
+        else:
+            response = jsonify(
+                success=True,
+                cancelled=control == CANCEL,
+            )
+
+    response.headers.add('Access-Control-Allow-Origin', '*')
+
+    return response
+
+
+@app.route(
+    "/stop/<job_key>",
+    methods=[
+        "GET",
+        "POST",
+    ],
+)
+def stop(job_key):
+    """
+    Ends a job early, keeping the frames generated so far as its result. A
+    job still in its queue is cancelled instead.
+    """
+    return control_job(job_key, STOP)
+
+
+@app.route(
+    "/cancel/<job_key>",
+    methods=[
+        "GET",
+        "POST",
+    ],
+)
+def cancel(job_key):
+    """
+    Ends a job early, discarding its frames.
+    """
+    return control_job(job_key, CANCEL)
+
+
+@app.route("/upload", methods=['POST'])
+def upload():
+    """
+    Stores conditioning images in the blob store. Accepts multipart uploads
+    (any number of files) or a raw binary body, and returns the blob ids to
+    pass to `/generate` as `condImgId` or `condImgIdArray`.
+    """
+    if len(request.files) > 0:
+        blob_id_list = [
+            save_blob_from_stream(file.stream)
+            for file_key in request.files
+            for file in request.files.getlist(file_key)
+        ]
+    else:
+        blob_id_list = [save_blob_from_stream(request.stream)]
+
+    response = jsonify(
+        success=True,
+        blobId=blob_id_list[0],
+        blobIdList=blob_id_list,
+    )
+    response.headers.add('Access-Control-Allow-Origin', '*')
+
+    return response
+
+
 @app.route(
     "/generate",
     methods=[
         "GET",
+        "POST",
     ],
 )
 def generate():
-    num_iterations = int(request.args.get('numIterations'))
-    resolution = request.args.get('resolution')
-    model = request.args.get('model')
+    # NOTE: query string and form fields, so that both GET and POST work
+    params = request.values
+
+    num_iterations = int(params.get('numIterations'))
+    resolution = params.get('resolution')
+    model = params.get('model')
+    seed = int(params.get('seed', 0))
     job_id = -1
 
-    if request.args.get('storyGeneration') == 'true':
-        prompt_list = request.args.get('promptArray').split(',')
+    if model not in MODEL_LIST:
+        response = jsonify(
+            success=False,
+            error="MODEL NOT RECOGNIZED",
+        )
+        response.headers.add('Access-Control-Allow-Origin', '*')
+
+        return response
+
+    if params.get('storyGeneration') == 'true':
+        prompt_list = params.get('promptArray').split(',')
         duration_list = [
-            float(dur) for dur in request.args.get('durationArray').split(',')
+            float(dur) for dur in params.get('durationArray').split(',')
         ]
         prompt_list = ['_'.join(prompt.split(' ')) for prompt in prompt_list]
 
-        cond_img_array_base64 = request.args.get('condImgArray')
-        if cond_img_array_base64 != "":
+        cond_img_array_base64 = params.get('condImgArray', '')
+        if 'condImgArray' in request.files:
+            img_id_list = [
+                save_blob_from_stream(file.stream)
+                for file in request.files.getlist('condImgArray')
+            ]
+        elif params.get('condImgIdArray', '') != '':
+            img_id_list = [
+                img_id if is_blob_id(img_id) else None
+                for img_id in params.get('condImgIdArray').split(',')
+            ]
+        elif cond_img_array_base64 != "":
             cond_img_array_base64_list = cond_img_array_base64.split(',')
             cond_img64_list = [
                 cond_img_array_base64_list[idx] +
                 cond_img_array_base64_list[idx + 1]
                 for idx in range(0, len(cond_img_array_base64_list), 2)
             ]
-            img_list = [
-                base64_to_PIL(img_base64.split('base64')[1])
-                for img_base64 in cond_img64_list
+            img_id_list = [
+                base64_to_blob(img_base64) for img_base64 in cond_img64_list
             ]
         else:
-            img_list = None
+            img_id_list = None
 
-        out_dir = f"public/generations/{'-'.join(prompt_list)}"
+        job_id = get_request_fingerprint({
+            'storyGeneration': True,
+            'promptList': prompt_list,
+            'durationList': duration_list,
+            'model': model,
+            'numIterations': num_iterations,
+            'resolution': resolution,
+            'imgIdList': img_id_list,
+            'seed': seed,
+        })
+        out_dir = f"public/generations/{job_id}"
         os.makedirs(out_dir, exist_ok=True)
 
         args = (
             prompt_list,
-            img_list,
+            img_id_list,
             duration_list,
             model,
             num_iterations,
             resolution,
             out_dir,
+            seed,
         )
 
-        job = q.enqueue_call(
-            func=story_generation,
-            args=args,
-            result_ttl=5000,
-            timeout=5000,
+        queue_name = get_queue_name(
+            model,
+            get_job_priority(True, num_iterations),
+        )
+        enqueued = enqueue_generation(
+            STORY_GENERATION_FUNC,
+            args,
+            job_id,
+            queue_name,
         )
-        job_id = job.get_id()
-        print(f"JOB ID: {job_id}")
+        print(f"JOB ID: {job_id} ON {queue_name} (enqueued: {enqueued})")
 
     else:
-        cond_img_base64 = request.args.get('condImg')
-        if cond_img_base64 != "undefined":
-            img_list = [base64_to_PIL(cond_img_base64.split('base64')[1])]
+        cond_img_base64 = params.get('condImg', 'undefined')
+        if 'condImg' in request.files:
+            img_id_list = [
+                save_blob_from_stream(request.files['condImg'].stream)
+            ]
+        elif is_blob_id(params.get('condImgId')):
+            img_id_list = [params.get('condImgId')]
+        elif cond_img_base64 != "undefined":
+            img_id_list = [base64_to_blob(cond_img_base64)]
         else:
-            img_list = None
+            img_id_list = None
 
-        prompt = request.args.get('prompt')
-        generate_video = True if request.args.get(
+        prompt = params.get('prompt')
+        generate_video = True if params.get(
             'videoGeneration') == 'true' else False
-        generate_img = True if request.args.get(
+        generate_img = True if params.get(
             'imageGeneration') == 'true' else False
-        out_dir = f"public/generations/{prompt}"
+        # NOTE: start from the latents of the most similar prompt generated
+        # so far, see `latent_store`
+        warm_start = True if params.get('warmStart') == 'true' else False
+        job_id = get_request_fingerprint({
+            'storyGeneration': False,
+            'prompt': prompt,
+            'model': model,
+            'numIterations': num_iterations,
+            'resolution': resolution,
+            'imgIdList': img_id_list,
+            'imageGeneration': generate_img,
+            'videoGeneration': generate_video,
+            'seed': seed,
+            'warmStart': warm_start,
+        })
+        # NOTE: named after the fingerprint so that different requests with
+        # the same prompt do not overwrite each other
+        out_dir = f"public/generations/{job_id}"
         os.makedirs(out_dir, exist_ok=True)
 
         args = (
             prompt,
-            img_list,
+            img_id_list,
             model,
             num_iterations,
             resolution,
             out_dir,
             generate_img,
             generate_video,
+            seed,
+            warm_start,
         )
 
-        job = q.enqueue_call(
-            func=single_generation,
-            args=args,
-            result_ttl=5000,
-            timeout=5000,
+        queue_name = get_queue_name(
+            model,
+            get_job_priority(False, num_iterations),
+        )
+        enqueued = enqueue_generation(
+            SINGLE_GENERATION_FUNC,
+            args,
+            job_id,
+            queue_name,
         )
-        job_id = job.get_id()
-        print(f"JOB ID: {job_id}")
+        print(f"JOB ID: {job_id} ON {queue_name} (enqueued: {enqueued})")
 
     response = jsonify(
         success=True,
@@ -156,4 +553,5 @@ if __name__ == "__main__":
     app.run(
         host="0.0.0.0",
         port=8000,
+        threaded=True,
     )
@@ -1,35 +1,148 @@
-import imageio
+import os
 from typing import *
 
-import numpy as np
 import torch
-
-from models.taming.taming_decoder import TamingDecoder
-from models.stylegan import StyleGAN
-from models import aphantasia
+from rq import get_current_job
+
+from model_utils import get_model, MODEL_LIST
+from models.session import run_session, get_rng_state
+from models.convergence import ConvergenceMonitor
+from blob_store import load_img
+from progress import ProgressReporter, publish_result
+from result_cache import cache_result, release_inflight
+from job_control import JobControl, get_control, STOP, CANCEL
+from frame_sinks import PreviewFrameSink, VideoFrameSink
+from latent_store import save_latents, find_latents, WARM_START_NOISE_FRAC
 # from models import dalle_decoder
 
+# NOTE: aphantasia spectra are optimized coarse to fine, see
+# `aphantasia.get_resolution_schedule`
+APHANTASIA_RESOLUTION_STAGES = 3
 
-def single_generation(
+# NOTE: end the optimization once the CLIP loss plateaus, `numIterations` is
+# then the maximum number of steps, see `convergence.ConvergenceMonitor`
+EARLY_STOPPING = os.getenv('EARLY_STOPPING', '1') == '1'
+
+
+def load_img_list(img_id_list: Optional[List[str]], ):
+    """
+    Loads the conditioning images referenced by blob id, skipping the missing
+    ones. Returns None when there is no image to load.
+    """
+    if img_id_list is None:
+        return None
+
+    img_list = [
+        load_img(img_id) for img_id in img_id_list if img_id is not None
+    ]
+    if len(img_list) == 0:
+        return None
+
+    return img_list
+
+
+def get_job_reporting(
+    conn,
+    job_id: str,
+    out_dir: str,
+    prompt_idx: int = 0,
+    num_prompts: int = 1,
+):
+    """
+    Returns the session callbacks and frame sinks publishing the progress and
+    the preview frames of a job, and checking whether it was stopped or
+    cancelled.
+    """
+    preview_sink = PreviewFrameSink(out_dir, conn=conn, job_id=job_id)
+    progress_reporter = ProgressReporter(
+        conn,
+        job_id,
+        prompt_idx=prompt_idx,
+        num_prompts=num_prompts,
+        preview_sink=preview_sink,
+    )
+
+    return [progress_reporter, JobControl(conn, job_id)], [preview_sink]
+
+
+def get_convergence_monitor():
+    return ConvergenceMonitor(stop_on_convergence=EARLY_STOPPING)
+
+
+def warm_start_session(session, ):
+    """
+    Starts the session from the stored latents of the most similar prompt
+    already generated with the same model and latent shape, if any.
+    """
+    model = session.extra['model_name']
+    latent_shape = session.extra.get(
+        'final_latent_shape',
+        tuple(session.latents.shape),
+    )
+
+    latents = find_latents(model, latent_shape, session.text_logits)
+    if latents is None:
+        return
+
+    get_model(model).warm_start_session(
+        session,
+        latents,
+        noise_frac=WARM_START_NOISE_FRAC,
+    )
+
+
+def finish_job(
+    conn,
+    job_id: str,
+    response: Dict,
+):
+    """
+    Publishes the result of a job and, if it succeeded, stores it in the
+    result index. Job ids are request fingerprints, so identical requests get
+    the stored result instead of running again.
+    """
+    publish_result(conn, job_id, response)
+
+    # NOTE: stopped jobs are partial results of the request
+    if response['success'] and not response.get('stopped', False):
+        cache_result(conn, job_id, response)
+    release_inflight(conn, job_id)
+
+
+def get_batch_key(
     prompt,
-    img_list,
+    img_id_list,
     model,
     num_iterations,
     resolution,
-    out_dir,
-    generate_img,
-    generate_video,
+    *args,
+    **kwargs,
 ):
-    img_url = ''
-    video_url = ''
+    """
+    Jobs with the same batch key can be optimized together in one batch.
+    """
+    if model == 'aphantasia':
+        return (model, resolution)
+
+    return (model, )
 
+
+def init_model_session(
+    prompt,
+    img_id_list,
+    model,
+    num_iterations,
+    resolution,
+):
     if model == 'aphantasia':
-        gen_img_list, feat_list = aphantasia.generate_from_prompt(
+        aphantasia = get_model('aphantasia')
+        session = aphantasia.init_session(
             prompt=prompt,
             lr=0.9,
             num_generations=num_iterations,
             img_save_freq=1,
             resolution=resolution,
+            num_resolution_stages=APHANTASIA_RESOLUTION_STAGES,
         )
     # elif model == 'dalle':
     #     gen_img_list = dalle_decoder.generate_from_prompt(
@@ -39,16 +152,17 @@ def single_generation(
     #         img_save_freq=1,
     #     )
     elif model == 'stylegan':
-        stylegan = StyleGAN()
-        gen_img_list, _feat_list = stylegan.generate_from_prompt(
+        stylegan = get_model('stylegan')
+        session = stylegan.init_session(
             prompt=prompt,
             lr=3e-2,
             num_generations=num_iterations,
             img_save_freq=1,
         )
     elif model == 'taming':
-        taming_decoder = TamingDecoder()
+        taming_decoder = get_model('taming')
 
+        img_list = load_img_list(img_id_list)
         if img_list is not None:
             img_processed_list = [
                 taming_decoder.vqgan_preprocess(img) for img in img_list
@@ -62,7 +176,7 @@ def single_generation(
         else:
             lr = 0.5
 
-        gen_img_list, _feat_list = taming_decoder.generate_from_prompt(
+        session = taming_decoder.init_session(
             prompt=prompt,
             lr=lr,
             img_save_freq=1,
@@ -70,15 +184,90 @@ def single_generation(
             num_random_crops=20,
             img_batch=img_batch,
         )
+        # NOTE: the latents encode the conditioning image
+        session.extra['conditioned'] = img_batch is not None
 
     else:
+        raise ValueError(f"MODEL {model} NOT RECOGNIZED")
+
+    return session
+
+
+def init_single_session(
+    prompt,
+    img_id_list,
+    model,
+    num_iterations,
+    resolution,
+    out_dir,
+    generate_img,
+    generate_video,
+    seed=0,
+    warm_start=False,
+):
+    # NOTE: the seed is part of the request fingerprint. It seeds an RNG state
+    # owned by the session, the global RNG is left untouched since other
+    # sessions may be running in the same batch
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        session = init_model_session(
+            prompt,
+            img_id_list,
+            model,
+            num_iterations,
+            resolution,
+        )
+        session.rng_state = get_rng_state()
+
+    session.extra['model_name'] = model
+    session.extra['out_dir'] = out_dir
+    session.extra['generate_img'] = generate_img
+    session.extra['generate_video'] = generate_video
+
+    # NOTE: the stored latents would replace the conditioning
+    if warm_start and not session.extra.get('conditioned', False):
+        warm_start_session(session)
+
+    session.callback_list.append(get_convergence_monitor())
+
+    if generate_video:
+        # NOTE: the video is encoded while the optimization runs, so only the
+        # latest frame is kept for the final image
+        session.extra['out_video_path'] = f"{out_dir}/video.mp4"
+        session.frame_sink_list.append(
+            VideoFrameSink(session.extra['out_video_path'], fps=5))
+        session.keep_all_frames = False
+
+    return session
+
+
+def finalize_single_generation(session, ):
+    session.close_frame_sinks()
+
+    if session.cancelled:
+        if session.extra['generate_video'] and os.path.exists(
+                session.extra['out_video_path']):
+            os.remove(session.extra['out_video_path'])
+
         response = {
             "success": False,
-            "error": "MODEL NOT RECOGNIZED",
+            "error": "JOB CANCELLED",
         }
         return response
 
-    if generate_img:
+    img_url = ''
+    video_url = ''
+
+    out_dir = session.extra['out_dir']
+    gen_img_list = session.gen_img_list
+    if len(gen_img_list) == 0:
+        response = {
+            "success": False,
+            "error": "NO FRAMES GENERATED",
+        }
+        return response
+
+    if session.extra['generate_img']:
         out_img_path = f"{out_dir}/img.png"
 
         generated_img = gen_img_list[-1]
@@ -86,55 +275,133 @@ def single_generation(
 
         img_url = '/'.join(out_img_path.split('/')[1:])
 
-    if generate_video:
-        out_video_path = f"{out_dir}/video.mp4"
-        writer = imageio.get_writer(out_video_path, fps=5)
-
-        for pil_img in gen_img_list:
-            img = np.array(pil_img, dtype=np.uint8)
-            writer.append_data(img)
-
-        writer.close()
-
-        video_url = '/'.join(out_video_path.split('/')[1:])
+    if session.extra['generate_video']:
+        video_url = '/'.join(session.extra['out_video_path'].split('/')[1:])
+
+    # NOTE: only converged latents are worth starting other jobs from, and
+    # not those of image conditioned jobs since the store is only keyed by the
+    # prompt
+    if not session.stopped and not session.extra.get('conditioned', False):
+        save_latents(
+            session.extra['model_name'],
+            session.text_logits,
+            session.latents,
+        )
 
     response = {
         'success': True,
         'imgUrl': img_url,
         'videoUrl': video_url,
+        'stopped': session.stopped,
+        'numSteps': session.step,
     }
 
     return response
 
 
+def single_generation(
+    prompt,
+    img_id_list,
+    model,
+    num_iterations,
+    resolution,
+    out_dir,
+    generate_img,
+    generate_video,
+    seed=0,
+    warm_start=False,
+):
+    if model not in MODEL_LIST:
+        response = {
+            "success": False,
+            "error": "MODEL NOT RECOGNIZED",
+        }
+        return response
+
+    session = init_single_session(
+        prompt,
+        img_id_list,
+        model,
+        num_iterations,
+        resolution,
+        out_dir,
+        generate_img,
+        generate_video,
+        seed=seed,
+        warm_start=warm_start,
+    )
+    job = get_current_job()
+    if job is not None:
+        callback_list, frame_sink_list = get_job_reporting(
+            job.connection,
+            job.id,
+            out_dir,
+        )
+        session.callback_list.extend(callback_list)
+        session.frame_sink_list.extend(frame_sink_list)
+
+    run_session(get_model(model).batched_step, session)
+
+    response = finalize_single_generation(session)
+
+    if job is not None:
+        finish_job(job.connection, job.id, response)
+
+    return response
+
+
 def story_generation(
     prompt_list,
-    img_list,
+    img_id_list,
     duration_list,
     model,
     num_iterations,
     resolution,
     out_dir,
+    seed=0,
 ):
+    torch.manual_seed(seed)
+    job = get_current_job()
+
     interp_img_list = []
     interp_feat_list = []
+    control = None
+    num_steps = 0
     for idx, prompt in enumerate(prompt_list):
         print(f"USING {model}")
+        convergence_monitor = get_convergence_monitor()
+        callback_list = [convergence_monitor]
+        frame_sink_list = None
+        if job is not None:
+            job_callback_list, frame_sink_list = get_job_reporting(
+                job.connection,
+                job.id,
+                out_dir,
+                prompt_idx=idx,
+                num_prompts=len(prompt_list),
+            )
+            callback_list.extend(job_callback_list)
+
         if model == 'aphantasia':
+            aphantasia = get_model('aphantasia')
             gen_img_list, feat_list = aphantasia.generate_from_prompt(
                 prompt=prompt,
                 lr=0.8,
                 num_generations=num_iterations,
                 img_save_freq=1,
                 resolution=resolution,
+                num_resolution_stages=APHANTASIA_RESOLUTION_STAGES,
+                callback_list=callback_list,
+                frame_sink_list=frame_sink_list,
+                keep_all_frames=False,
             )
-            interp_img_list.append(gen_img_list[-1])
-            interp_feat_list.append(feat_list[-1])
 
         elif model == 'taming':
-            taming_decoder = TamingDecoder()
-            if img_list is not None:
-                img_sublist = [img_list[idx]]
+            taming_decoder = get_model('taming')
+            img_sublist = None
+            if img_id_list is not None and idx < len(img_id_list):
+                img_sublist = load_img_list([img_id_list[idx]])
+            if img_sublist is not None:
                 img_processed_list = [
                     taming_decoder.vqgan_preprocess(img) for img in img_sublist
                 ]
@@ -154,21 +421,22 @@ def story_generation(
                 num_generations=num_iterations,
                 num_random_crops=20,
                 img_batch=img_batch,
+                callback_list=callback_list,
+                frame_sink_list=frame_sink_list,
+                keep_all_frames=False,
             )
 
-            interp_img_list.append(gen_img_list[-1])
-            interp_feat_list.append(feat_list[-1])
-
         elif model == 'stylegan':
-            stylegan = StyleGAN()
+            stylegan = get_model('stylegan')
             gen_img_list, feat_list = stylegan.generate_from_prompt(
                 prompt=prompt,
                 lr=6e-3,
                 num_generations=num_iterations,
                 img_save_freq=1,
+                callback_list=callback_list,
+                frame_sink_list=frame_sink_list,
+                keep_all_frames=False,
             )
-            interp_img_list.append(gen_img_list[-1])
-            interp_feat_list.append(feat_list[-1])
 
         else:
             response = {
@@ -177,43 +445,109 @@ def story_generation(
             }
             return response
 
+        num_steps += convergence_monitor.num_steps
+
+        # NOTE: a prompt stopped before its first step has no frame
+        if len(feat_list) > 0:
+            interp_img_list.append(gen_img_list[-1])
+            interp_feat_list.append(feat_list[-1])
+
+        if job is not None:
+            control = get_control(job.connection, job.id)
+
+        if control == CANCEL:
+            response = {
+                "success": False,
+                "error": "JOB CANCELLED",
+            }
+            finish_job(job.connection, job.id, response)
+            return response
+        elif control == STOP:
+            break
+
+    if len(interp_feat_list) == 0:
+        response = {
+            "success": False,
+            "error": "NO FRAMES GENERATED",
+        }
+        if job is not None:
+            finish_job(job.connection, job.id, response)
+        return response
+
+    out_video_path = f"{out_dir}/interpolation.mp4"
+    video_sink = VideoFrameSink(out_video_path, fps=25)
+
+    def should_stop():
+        """
+        Checked between interpolation chunks. A stop received while the
+        prompts were optimized only ends that phase, the rendering then runs
+        to the end unless the job is cancelled.
+        """
+        if job is None:
+            return False
+
+        interp_control = get_control(job.connection, job.id)
+        return interp_control == CANCEL or (interp_control == STOP
+                                            and control != STOP)
+
     if model == 'aphantasia':
-        interp_result_img_list = aphantasia.interpolate(
+        aphantasia = get_model('aphantasia')
+        aphantasia.interpolate(
             interp_feat_list,
             duration_list,
             resolution=resolution,
+            frame_sink_list=[video_sink],
+            keep_all_frames=False,
+            should_stop=should_stop,
         )
 
     elif model == 'taming':
-        taming_decoder = TamingDecoder()
-        interp_result_img_list = taming_decoder.interpolate(
+        taming_decoder = get_model('taming')
+        taming_decoder.interpolate(
             interp_feat_list,
             duration_list,
+            frame_sink_list=[video_sink],
+            keep_all_frames=False,
+            should_stop=should_stop,
         )
 
     elif model == 'stylegan':
-        stylegan = StyleGAN()
-        interp_result_img_list = stylegan.interpolate(
+        stylegan = get_model('stylegan')
+        stylegan.interpolate(
             interp_feat_list,
             duration_list,
+            frame_sink_list=[video_sink],
+            keep_all_frames=False,
+            should_stop=should_stop,
         )
 
-    out_video_path = f"{out_dir}/interpolation.mp4"
-    
-    writer = imageio.get_writer(out_video_path, fps=25)
+    video_sink.close()
+
+    if job is not None:
+        control = get_control(job.connection, job.id)
 
-    for pil_img in interp_result_img_list:
-        img = np.array(pil_img, dtype=np.uint8)
-        writer.append_data(img)
+    if control == CANCEL:
+        if os.path.exists(out_video_path):
+            os.remove(out_video_path)
+
+        response = {
+            "success": False,
+            "error": "JOB CANCELLED",
+        }
+        finish_job(job.connection, job.id, response)
+        return response
 
-    writer.close()
-    
     video_url = '/'.join(out_video_path.split('/')[1:])
 
     response = {
         "success": True,
         "imgUrl": '',
         "videoUrl": video_url,
+        "stopped": control == STOP,
+        "numSteps": num_steps,
     }
 
-    return response
\ No newline at end of file
+    if job is not None:
+        finish_job(job.connection, job.id, response)
+
+    return response
@@ -1,18 +1,217 @@
 import os
 import sys
+import time
+import signal
+import argparse
 
 import redis
-from rq import Worker, Queue, Connection
+from rq import Worker, SimpleWorker, Queue, Connection
 
 sys.path.append("./server")
 
-listen = ['default']
-
 redis_url = os.getenv('REDISTOGO_URL', 'redis://localhost:6379')
 
 conn = redis.from_url(redis_url)
 
-if __name__ == '__main__':
+
+def run_worker(
+    listen,
+    max_batch_size: int = 1,
+    preloaded: bool = True,
+):
+    """
+    Workers with preloaded models run the jobs in their own process, a
+    forked work horse could not use them on CUDA and would fork a live
+    OpenMP thread pool. Without preloaded models every job runs in a forked
+    work horse that loads the models it needs.
+    """
     with Connection(conn):
-        worker = Worker(list(map(Queue, listen)))
+        if max_batch_size > 1:
+            from scheduler import BatchingWorker
+            worker = BatchingWorker(
+                list(map(Queue, listen)),
+                max_batch_size=max_batch_size,
+            )
+        elif preloaded:
+            worker = SimpleWorker(list(map(Queue, listen)))
+        else:
+            worker = Worker(list(map(Queue, listen)))
         worker.work()
+
+
+def supervise(
+    num_workers: int,
+    listen,
+    max_batch_size: int = 1,
+    worker_model_list=None,
+    num_threads: int = 0,
+):
+    """
+    Forks `num_workers` workers from this process once the models are loaded
+    and their weights moved to shared memory, so every worker reads the same
+    weights instead of loading its own copy. Workers that die are restarted,
+    SIGTERM is forwarded to them for a warm shutdown.
+    """
+    import torch
+    import model_utils
+
+    if num_threads <= 0:
+        num_threads = max(1, os.cpu_count() // num_workers)
+
+    def spawn_worker():
+        pid = os.fork()
+        if pid != 0:
+            return pid
+
+        # NOTE: RQ installs its own handlers once the worker starts
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        exit_code = 1
+        try:
+            # NOTE: the cores are split between the workers
+            torch.set_num_threads(num_threads)
+            model_utils.warmup_models(worker_model_list)
+            # NOTE: jobs run in the worker itself, forking a work horse would
+            # put the shared weights behind a second fork
+            run_worker(
+                listen,
+                max_batch_size=max_batch_size,
+                preloaded=True,
+            )
+            exit_code = 0
+        finally:
+            os._exit(exit_code)
+
+    pid_set = set()
+    shutting_down = False
+
+    def handle_signal(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        # NOTE: SIGINT from a terminal already reaches the whole group
+        if signum == signal.SIGTERM:
+            for pid in pid_set:
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    for _ in range(num_workers):
+        pid_set.add(spawn_worker())
+    print(f"Supervising {num_workers} workers {sorted(pid_set)}")
+
+    while len(pid_set) > 0:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        pid_set.discard(pid)
+        if shutting_down:
+            continue
+
+        print(f"Worker {pid} exited with status {status}, restarting it")
+        # NOTE: avoids a tight loop if workers die right after starting
+        time.sleep(1)
+        pid_set.add(spawn_worker())
+
+
+if __name__ == '__main__':
+    # NOTE: imported here so that the API process, which only needs `conn`,
+    # does not pull in the ML stack
+    import model_utils
+    # NOTE: job functions are enqueued by import path, importing them here
+    # lets every work horse inherit them instead of importing them per job
+    import server_utils
+    from models import clip_utils
+    import latent_store
+    from queues import PRIORITY_LIST, get_worker_queue_name_list
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--models',
+        type=str,
+        default=os.getenv('WORKER_MODELS', ','.join(model_utils.MODEL_LIST)),
+        help='Comma separated models this worker keeps resident and serves',
+    )
+    parser.add_argument(
+        '--priorities',
+        type=str,
+        default=os.getenv('WORKER_PRIORITIES', ','.join(PRIORITY_LIST)),
+        help='Comma separated priority tiers this worker serves',
+    )
+    parser.add_argument(
+        '--max_batch_size',
+        type=int,
+        default=int(os.getenv('WORKER_MAX_BATCH_SIZE', '1')),
+        help='Jobs optimized together, 1 disables batching',
+    )
+    parser.add_argument(
+        '--preload',
+        type=int,
+        default=int(os.getenv('WORKER_PRELOAD', '1')),
+        help='1 keeps the models resident and runs jobs in this process, 0 '
+        'forks a work horse per job that loads its models',
+    )
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=int(os.getenv('WORKER_PROCESSES', '1')),
+        help='Worker processes forked after loading the models, which share '
+        'their weights, 1 runs a single worker in this process',
+    )
+    parser.add_argument(
+        '--num_threads',
+        type=int,
+        default=int(os.getenv('WORKER_NUM_THREADS', '0')),
+        help='Torch threads per forked worker, 0 splits the cores evenly',
+    )
+    args, _unknown_args = parser.parse_known_args()
+
+    worker_model_list = args.models.split(',')
+    listen = get_worker_queue_name_list(
+        worker_model_list,
+        args.priorities.split(','),
+    )
+    print(f"Listening on {listen}")
+
+    # NOTE: prompt embeddings are shared with every worker on this Redis
+    clip_utils.set_text_embedding_backend(redis_conn=conn)
+    latent_store.set_latent_store_backend(redis_conn=conn)
+
+    if args.num_workers > 1:
+        import torch
+
+        if not args.preload:
+            parser.error("--num_workers above 1 shares preloaded models, it "
+                         "cannot be used with --preload 0")
+
+        if torch.cuda.is_available():
+            parser.error("--num_workers above 1 is only supported on CPU, "
+                         "CUDA cannot be used after forking")
+
+        # NOTE: the supervisor does not compute anything itself, keeping it
+        # single threaded avoids forking with a live OpenMP thread pool
+        torch.set_num_threads(1)
+        model_utils.load_models(worker_model_list, warmup=False)
+
+        num_shared_bytes = model_utils.share_model_memory()
+        print(f"Shared {num_shared_bytes / 2**20:.0f} MB of weights")
+
+        supervise(
+            args.num_workers,
+            listen,
+            max_batch_size=args.max_batch_size,
+            worker_model_list=worker_model_list,
+            num_threads=args.num_threads,
+        )
+    else:
+        if args.preload:
+            model_utils.load_models(worker_model_list, warmup=True)
+
+        run_worker(
+            listen,
+            max_batch_size=args.max_batch_size,
+            preloaded=bool(args.preload),
+        )